@@ -0,0 +1,43 @@
+"""
+Request handler for the game server API
+
+Game servers only need ServerAuthenticationMiddleware, the sessions, users, messages and timezones of the site
+middleware are skipped for their requests. See wsgi.py for how requests are dispatched to this handler.
+"""
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.wsgi import WSGIHandler
+from django.utils.module_loading import import_by_path
+
+
+class APIHandler(WSGIHandler):
+    """WSGI handler running settings.API_MIDDLEWARE_CLASSES instead of settings.MIDDLEWARE_CLASSES"""
+
+    def load_middleware(self):
+        # same as BaseHandler.load_middleware, except for the list of middleware
+        self._view_middleware = []
+        self._template_response_middleware = []
+        self._response_middleware = []
+        self._exception_middleware = []
+
+        request_middleware = []
+        for middleware_path in settings.API_MIDDLEWARE_CLASSES:
+            mw_class = import_by_path(middleware_path)
+            try:
+                mw_instance = mw_class()
+            except MiddlewareNotUsed:
+                continue
+
+            if hasattr(mw_instance, 'process_request'):
+                request_middleware.append(mw_instance.process_request)
+            if hasattr(mw_instance, 'process_view'):
+                self._view_middleware.append(mw_instance.process_view)
+            if hasattr(mw_instance, 'process_template_response'):
+                self._template_response_middleware.insert(0, mw_instance.process_template_response)
+            if hasattr(mw_instance, 'process_response'):
+                self._response_middleware.insert(0, mw_instance.process_response)
+            if hasattr(mw_instance, 'process_exception'):
+                self._exception_middleware.insert(0, mw_instance.process_exception)
+
+        # assigned last, it flags that initialization is complete
+        self._request_middleware = request_middleware
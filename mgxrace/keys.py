@@ -2,4 +2,5 @@
 cfg = {
     'secret': None,
     'db_pass': None,
+    'memcached': None,  # e.g. '127.0.0.1:11211'
 }
\ No newline at end of file
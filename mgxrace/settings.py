@@ -7,12 +7,15 @@ https://docs.djangoproject.com/en/1.6/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/1.6/ref/settings/
 """
+# without it, 'celery' below would be the sibling mgxrace/celery.py
+from __future__ import absolute_import
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
 import sys
 from datetime import timedelta
-from keys import cfg
+from celery.schedules import crontab
+from mgxrace.keys import cfg
 
 import djcelery
 djcelery.setup_loader()
@@ -73,6 +76,12 @@ MIDDLEWARE_CLASSES = (
     'racesow.middleware.TimezoneMiddleware',
 )
 
+# requests starting with API_PATH_PREFIX only run API_MIDDLEWARE_CLASSES, see mgxrace/wsgi.py
+API_PATH_PREFIX = '/api/'
+API_MIDDLEWARE_CLASSES = (
+    'racesow.middleware.ServerAuthenticationMiddleware',
+)
+
 ROOT_URLCONF = 'mgxrace.urls'
 
 WSGI_APPLICATION = 'mgxrace.wsgi.application'
@@ -95,6 +104,27 @@ DATABASES = {
     }
 }
 
+# cache of the game server API, see racesow/cache.py. Its entries are dropped by whichever process changes the data, so
+# it needs a backend shared by all processes. Without a memcached address in keys.py nothing is cached at all
+if cfg.get('memcached'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': cfg.get('memcached'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+        }
+    }
+
+MAP_CACHE_TIMEOUT = 300
+
+# precomputed Racesow 1.0 leaderboards, see racesowold/leaderboards.py and the build_legacy_leaderboards command
+LEGACY_LEADERBOARD_DIR = os.path.join(BASE_DIR, 'legacy_leaderboards')
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -126,11 +156,44 @@ INTERNAL_IPS = ['127.0.0.1']
 
 CELERYD_HIJACK_ROOT_LOGGER = False
 
+# engine used by racesow.services.map_evaluate_points: 'bulk' (set-based writes) or 'loop' (row-by-row saves)
+POINTS_ENGINE = 'bulk'
+
+# number of map shards racesow.tasks.force_recompute_all fans out to the celery workers
+RECOMPUTE_SHARDS = 8
+
+# points of a map are computed once it has had no new races/playtimes for POINTS_DEBOUNCE seconds,
+# or at the latest POINTS_MAX_DELAY seconds after it was first queued
+POINTS_DEBOUNCE = 30
+POINTS_MAX_DELAY = 300
+
+# playtime and race counters are buffered by racesow.counters and written every COUNTER_FLUSH_INTERVAL seconds,
+# 0 writes them right away
+COUNTER_FLUSH_INTERVAL = 5
+
+# game servers are cached per process for SERVER_CACHE_TTL seconds (edits through the admin are picked up right away
+# by the process that saved them), a verified request token is accepted without hashing for SERVER_TOKEN_REPLAY_WINDOW
+# seconds
+SERVER_CACHE_TTL = 300
+SERVER_TOKEN_REPLAY_WINDOW = 60
+
 # http://celery.readthedocs.org/en/latest/userguide/periodic-tasks.html#entries
 CELERYBEAT_SCHEDULE = {
-    'evaluate-maps-every-1-minute': {
+    'dispatch-dirty-maps-every-5-seconds': {
         'task': 'racesow.tasks.recompute_updated_maps',
-        'schedule': timedelta(minutes=1),
+        'schedule': timedelta(seconds=5),
+    },
+    'retry-race-submissions-every-minute': {
+        'task': 'racesow.tasks.retry_race_submissions',
+        'schedule': timedelta(seconds=60),
+    },
+    'snapshot-leaderboards-every-day': {
+        'task': 'racesow.tasks.snapshot_leaderboards',
+        'schedule': crontab(hour=0, minute=5),
+    },
+    'purge-race-submissions-every-day': {
+        'task': 'racesow.tasks.purge_race_submissions',
+        'schedule': crontab(hour=0, minute=35),
     },
 }
 
@@ -160,6 +223,10 @@ LOGGING = {
             'level': 'INFO',
             'propagate': True,
         },
+        'racesow': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
         # 'django.request': {
         #     'handlers': ['mail_admins'],
         #     'level': 'ERROR',
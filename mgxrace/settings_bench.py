@@ -0,0 +1,24 @@
+"""
+Settings for benchmarking the points engine against a local SQLite database.
+
+Usage:
+    python manage.py syncdb --all --noinput --settings=mgxrace.settings_bench
+    python manage.py migrate --fake --settings=mgxrace.settings_bench
+    python manage.py benchmark_points --settings=mgxrace.settings_bench
+"""
+from mgxrace.settings import *
+
+DEBUG = False  # don't keep every generated INSERT in memory
+
+TEMPLATE_DEBUG = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'bench.sqlite3'),
+    }
+}
+
+# run celery tasks (and chords) inline instead of sending them to a broker
+CELERY_ALWAYS_EAGER = True
+BROKER_URL = 'memory://'
@@ -2,6 +2,9 @@
 WSGI config for mgxrace project.
 
 It exposes the WSGI callable as a module-level variable named ``application``.
+Requests for the game server API (settings.API_PATH_PREFIX) are handled with
+the minimal middleware of ``api_application``, which can also be mounted on
+its own.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/1.6/howto/deployment/wsgi/
@@ -10,5 +13,15 @@ https://docs.djangoproject.com/en/1.6/howto/deployment/wsgi/
 import os
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mgxrace.settings")
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
-application = get_wsgi_application()
+from mgxrace.handlers import APIHandler
+
+site_application = get_wsgi_application()
+api_application = APIHandler()
+
+
+def application(environ, start_response):
+    if environ.get('PATH_INFO', '').startswith(settings.API_PATH_PREFIX):
+        return api_application(environ, start_response)
+    return site_application(environ, start_response)
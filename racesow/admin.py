@@ -1,6 +1,6 @@
 from django.contrib import admin
-from .models import Tag, Server, Map, MapRating, PlayerHistory
-from .models import Player, RaceHistory, Race, Checkpoint
+from .models import Tag, Server, Map, MapRating, MapVersion, PlayerHistory
+from .models import Player, RaceHistory, Race, Checkpoint, PlayerSnapshot, MapSnapshot, RaceSubmission
 
 admin.site.register(Tag)
 admin.site.register(Server)
@@ -26,8 +26,12 @@ class MapAdmin(admin.ModelAdmin):
 
 admin.site.register(Map, MapAdmin)
 admin.site.register(MapRating)
+admin.site.register(MapVersion)
 admin.site.register(PlayerHistory)
 admin.site.register(Player)
 admin.site.register(RaceHistory)
 admin.site.register(Race)
-admin.site.register(Checkpoint)
\ No newline at end of file
+admin.site.register(Checkpoint)
+admin.site.register(PlayerSnapshot)
+admin.site.register(MapSnapshot)
+admin.site.register(RaceSubmission)
\ No newline at end of file
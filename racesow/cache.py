@@ -0,0 +1,276 @@
+"""
+Caches for the data game servers request on every map load
+
+Entries are stored in the default Django cache for settings.MAP_CACHE_TIMEOUT seconds, and deleted by the code that
+changes the underlying rows (see services.bump_map_version and APIMap.post) or through model signals for edits
+made elsewhere, e.g. in the admin. The cache has to be shared by all processes (memcached), otherwise a process would
+keep serving entries another one changed. The settings fall back to a dummy cache that stores nothing.
+
+Records are cached per map and per (player, map). The keys include a generation of the map that is incremented when
+the points of its races change, which drops the records of all players at once. The leaderboards of a map are cached
+as JSON per limit bucket under a generation that is incremented whenever a race is stored on the map. Likewise the
+map list generation is incremented whenever a map or its tags change, which makes every process rebuild its map list
+index.
+"""
+import hashlib
+import json
+import operator
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Min, Q
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save
+
+from racesow.models import Map, Race, Tag
+from racesow.serializers import mapSerializer, playerSerializer, raceSerializer
+
+MAP_ID_KEY = 'racesow:mapid:{}'  # md5 of map name -> map id
+MAP_KEY = 'racesow:map:{}'  # map id -> serialized map with its record
+RECORD_GENERATION_KEY = 'racesow:recordgen:{}'  # map id -> generation of the cached records of the map
+RECORD_KEY = 'racesow:record:{}:{}'  # map id, generation -> (serialized record race or None,)
+PLAYER_RECORD_KEY = 'racesow:record:{}:{}:{}'  # map id, generation, player id -> (serialized race or None,)
+LEADERBOARD_GENERATION_KEY = 'racesow:leaderboardgen:{}'  # map id -> generation of the cached leaderboards of the map
+LEADERBOARD_KEY = 'racesow:leaderboard:{}:{}:{}'  # map id, generation, limit bucket -> (oneliner, JSON of the races)
+SERVER_GENERATION_KEY = 'racesow:servergen:{}'  # server id -> generation of the server, see racesow.middleware
+MAP_LIST_GENERATION_KEY = 'racesow:maplistgen'  # generation of the map list index (see racesow.mapindex)
+
+MIN_LEADERBOARD_BUCKET = 16  # smallest number of races cached per leaderboard
+
+
+def _name_key(name):
+    # map names can contain characters that are not allowed in memcached keys. Names from the database are unicode,
+    # names sent by game servers utf-8 encoded
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return MAP_ID_KEY.format(hashlib.md5(name).hexdigest())
+
+
+def get_map_id(name):
+    """Returns the id of the map called 'name', None if there is no such map"""
+    key = _name_key(name)
+    mid = cache.get(key)
+    if mid is None:
+        ids = list(Map.objects.filter(name=name).values_list('id', flat=True)[:1])
+        if not ids:
+            return None
+        mid = ids[0]
+        cache.set(key, mid, settings.MAP_CACHE_TIMEOUT)
+    return mid
+
+
+def set_map_id(name, mid):
+    cache.set(_name_key(name), mid, settings.MAP_CACHE_TIMEOUT)
+
+
+def get_map_data(mid):
+    """Returns the serialized map 'mid' with its serialized record race (None if it has none), as sent by APIMap.get
+
+    :raises Map.DoesNotExist: if there is no map 'mid'
+    """
+    key = MAP_KEY.format(mid)
+    data = cache.get(key)
+    if data is None:
+        data = mapSerializer(Map.objects.prefetch_related('tags').get(pk=mid))
+        data['record'] = get_map_record(mid)
+        cache.set(key, data, settings.MAP_CACHE_TIMEOUT)
+    return data
+
+
+def _generation(key):
+    generation = cache.get(key)
+    if generation is None:
+        # start from the current time, so entries cached before the generation was evicted are not reused
+        generation = int(time.time() * 1000)
+        cache.add(key, generation, settings.MAP_CACHE_TIMEOUT)
+        generation = cache.get(key, generation)
+    return generation
+
+
+def _next_generation(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000), settings.MAP_CACHE_TIMEOUT)
+
+
+def _record_generation(mid):
+    return _generation(RECORD_GENERATION_KEY.format(mid))
+
+
+def get_map_record(mid):
+    """Returns the serialized fastest race of map 'mid', None if it has no races with a time"""
+    return get_map_records([mid])[mid]
+
+
+def get_map_records(mids):
+    """Returns the serialized fastest races of maps 'mids', with a constant number of queries for the cache misses
+
+    :return: dict of map id -> serialized record race, None for maps without races with a time
+    """
+    generations = cache.get_many([RECORD_GENERATION_KEY.format(mid) for mid in mids])
+    keys = dict((mid, RECORD_KEY.format(mid, generations.get(RECORD_GENERATION_KEY.format(mid)) or
+                                        _record_generation(mid))) for mid in mids)
+    cached = cache.get_many(keys.values())
+    records = dict((mid, cached[key][0]) for mid, key in keys.items() if key in cached)
+
+    missing = [mid for mid in mids if mid not in records]
+    if missing:
+        # best time per map, then the races with those times and their (unpacked) checkpoints
+        best_times = Race.objects.filter(map__in=missing, time__isnull=False).order_by().values_list('map')\
+            .annotate(Min('time'))
+        races = {}
+        if best_times:
+            flt = reduce(operator.or_, [Q(map_id=mid, time=best_time) for mid, best_time in best_times])
+            # on equal times the race stored first is the record
+            for race in Race.objects.filter(flt).order_by('-id').prefetch_related('checkpoint_set'):
+                races[race.map_id] = race
+
+        new = {}
+        for mid in missing:
+            records[mid] = raceSerializer(races[mid]) if mid in races else None
+            new[keys[mid]] = (records[mid],)
+        cache.set_many(new, settings.MAP_CACHE_TIMEOUT)
+    return records
+
+
+def get_player_record(pid, mid):
+    """Returns the serialized race of player 'pid' on map 'mid', None if the player has no time on the map"""
+    key = PLAYER_RECORD_KEY.format(mid, _record_generation(mid), pid)
+    cached = cache.get(key)
+    if cached is None:
+        races = Race.objects.filter(player_id=pid, map_id=mid, time__isnull=False)[:1]
+        cached = (raceSerializer(races[0]) if races else None,)
+        cache.set(key, cached, settings.MAP_CACHE_TIMEOUT)
+    return cached[0]
+
+
+def _leaderboard_bucket(limit):
+    # limits are rounded up to a power of two, so servers asking for different limits share most entries
+    return max(MIN_LEADERBOARD_BUCKET, 1 << (limit - 1).bit_length())
+
+
+def get_leaderboard(mid, limit):
+    """Returns the oneliner of map 'mid' and its 'limit' fastest races, as sent by APIRace.get
+
+    :return: (oneliner, list of JSON encoded races with their player)
+    :raises Map.DoesNotExist: if there is no map 'mid'
+    """
+    if limit <= 0:
+        return Map.objects.values_list('oneliner', flat=True).get(pk=mid), []
+
+    bucket = _leaderboard_bucket(limit)
+    key = LEADERBOARD_KEY.format(mid, _generation(LEADERBOARD_GENERATION_KEY.format(mid)), bucket)
+    cached = cache.get(key)
+    if cached is None:
+        oneliner = Map.objects.values_list('oneliner', flat=True).get(pk=mid)
+        races = []
+        for race in Race.objects.filter(map_id=mid, time__isnull=False).order_by('time')\
+                .select_related('player').prefetch_related('checkpoint_set')[:bucket]:
+            srace = raceSerializer(race)
+            srace['player'] = playerSerializer(race.player)
+            del srace['playerId']
+            races.append(json.dumps(srace))
+        cached = (oneliner, races)
+        cache.set(key, cached, settings.MAP_CACHE_TIMEOUT)
+    return cached[0], cached[1][:limit]
+
+
+def invalidate_leaderboards(mid):
+    """Drops the cached leaderboards of map 'mid', to be called when a race was stored on it"""
+    _next_generation(LEADERBOARD_GENERATION_KEY.format(mid))
+
+
+def race_stored(race):
+    """Writes a race that was just stored through to the cached records of its player and map"""
+    invalidate_leaderboards(race.map_id)
+    generation = _record_generation(race.map_id)
+    data = raceSerializer(race)
+    cache.set(PLAYER_RECORD_KEY.format(race.map_id, generation, race.player_id), (data,), settings.MAP_CACHE_TIMEOUT)
+
+    key = RECORD_KEY.format(race.map_id, generation)
+    cached = cache.get(key)
+    if cached is None:
+        # built on the next request
+        return
+    if cached[0] is None or race.time < cached[0]['time']:
+        cache.set(key, (data,), settings.MAP_CACHE_TIMEOUT)
+    elif cached[0]['id'] == race.id:
+        # the record got slower, another race may be the record now
+        cache.delete(key)
+
+
+def invalidate_records(mid):
+    """Drops the cached records of map 'mid' and of all players on it, to be called when their points changed"""
+    _next_generation(RECORD_GENERATION_KEY.format(mid))
+    invalidate_map(mid)
+
+
+def get_server_generation(sid):
+    """Returns the current generation of server 'sid', it changes whenever the server is edited or deleted"""
+    return _generation(SERVER_GENERATION_KEY.format(sid))
+
+
+def invalidate_server(sid):
+    """Outdates server 'sid' in the server caches of all processes"""
+    _next_generation(SERVER_GENERATION_KEY.format(sid))
+
+
+def get_map_list_generation():
+    """Returns the current generation of the map list index, it changes whenever a map or its tags change"""
+    return _generation(MAP_LIST_GENERATION_KEY)
+
+
+def invalidate_map_lists():
+    """Outdates the map list index of all processes, to be called when a map or its tags changed"""
+    _next_generation(MAP_LIST_GENERATION_KEY)
+
+
+def invalidate_map(mid):
+    """Deletes the cached data of map 'mid', to be called when its tags, oneliner or record changed"""
+    cache.delete(MAP_KEY.format(mid))
+    invalidate_leaderboards(mid)
+
+
+def _map_loaded(sender, instance, **kwargs):
+    # remember the name the map was loaded with, to drop its cached id when the map is renamed
+    instance._loaded_name = instance.__dict__.get('name')
+
+
+def _map_saved(sender, instance, **kwargs):
+    invalidate_map(instance.id)
+    invalidate_map_lists()
+    loaded_name = getattr(instance, '_loaded_name', None)
+    if loaded_name and loaded_name != instance.name:
+        cache.delete(_name_key(loaded_name))
+    instance._loaded_name = instance.name
+
+
+def _map_deleted(sender, instance, **kwargs):
+    invalidate_map(instance.id)
+    invalidate_map_lists()
+    cache.delete(_name_key(instance.name))
+
+
+def _map_tags_changed(sender, instance, action, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if isinstance(instance, Map):
+        invalidate_map(instance.id)
+    else:
+        # tag.map_set was changed
+        for mid in kwargs.get('pk_set') or ():
+            invalidate_map(mid)
+    invalidate_map_lists()
+
+
+def _tag_changed(sender, instance, **kwargs):
+    # deleting a tag removes it from its maps without an m2m_changed signal
+    invalidate_map_lists()
+
+post_init.connect(_map_loaded, sender=Map)
+post_save.connect(_map_saved, sender=Map)
+post_delete.connect(_map_deleted, sender=Map)
+m2m_changed.connect(_map_tags_changed, sender=Map.tags.through)
+post_save.connect(_tag_changed, sender=Tag)
+post_delete.connect(_tag_changed, sender=Tag)
@@ -0,0 +1,133 @@
+"""
+Write-behind buffer for the playtime and race counters of maps, players and races
+
+Game servers report playtimes and race counts continuously, mostly for the same few popular maps and players.
+Instead of read-modify-writing every row on each report, increments are summed up in this process and written every
+settings.COUNTER_FLUSH_INTERVAL seconds, with one atomic `column = column + increment` UPDATE per table.
+
+Increments that are still buffered when the process is killed are lost, they are statistics only.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from racesow.services import bulk_update
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_buffer = {}  # (model, pk) -> {field: increment}
+_oldest = None  # time.time() of the oldest buffered increment
+_last_flush_lag = 0.0  # seconds the oldest increment of the last flush was buffered
+_flusher_pid = None  # process that runs the flusher thread (threads do not survive a fork)
+
+
+def increment(model, pk, **fields):
+    """Adds the given increments to the counter columns of row 'pk' of 'model'.
+
+    Example: increment(Map, mid, races=2, playtime=53000)
+    """
+    global _oldest
+    with _lock:
+        counters = _buffer.setdefault((model, pk), {})
+        for field, value in fields.items():
+            counters[field] = counters.get(field, 0) + value
+        if _oldest is None:
+            _oldest = time.time()
+
+    interval = getattr(settings, 'COUNTER_FLUSH_INTERVAL', 5)
+    if interval <= 0:
+        # write-through
+        flush()
+    else:
+        _start_flusher(interval)
+
+
+def pending(model, pk, field):
+    """Returns the increment of a counter column of row 'pk' of 'model' that is buffered and not yet written"""
+    with _lock:
+        return _buffer.get((model, pk), {}).get(field, 0)
+
+
+def flush():
+    """Writes all buffered increments to the database.
+
+    :return: number of rows updated
+    """
+    global _buffer, _oldest, _last_flush_lag
+    with _lock:
+        buffer, _buffer = _buffer, {}
+        oldest, _oldest = _oldest, None
+    if not buffer:
+        return 0
+
+    tables = {}
+    for (model, pk), counters in buffer.items():
+        tables.setdefault(model, {})[pk] = counters
+
+    try:
+        with transaction.atomic():
+            for model, rows in tables.items():
+                fields = sorted(set(field for counters in rows.values() for field in counters))
+                bulk_update(model, dict((pk, tuple(counters.get(field, 0) for field in fields))
+                                        for pk, counters in rows.items()), fields, increment=True)
+    except Exception:
+        # put the increments back, so they are written with the next flush
+        with _lock:
+            for key, counters in buffer.items():
+                merged = _buffer.setdefault(key, {})
+                for field, value in counters.items():
+                    merged[field] = merged.get(field, 0) + value
+            _oldest = min(oldest, _oldest or oldest)
+        raise
+
+    _last_flush_lag = time.time() - oldest
+    logger.debug('flushed counters of {} rows, oldest increment was {:.1f}s old'.format(len(buffer), _last_flush_lag))
+    return len(buffer)
+
+
+def stats():
+    """Returns metrics of the buffer of this process.
+
+    :return: dict with the number of buffered rows ('rows') and increments ('increments'), the age in seconds of the
+             oldest buffered increment ('lag') and how old the oldest increment was at the last flush ('last_flush_lag')
+    """
+    with _lock:
+        return {
+            'rows': len(_buffer),
+            'increments': sum(len(counters) for counters in _buffer.values()),
+            'lag': time.time() - _oldest if _oldest is not None else 0.0,
+            'last_flush_lag': _last_flush_lag,
+        }
+
+
+def _start_flusher(interval):
+    global _flusher_pid
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+
+    thread = threading.Thread(target=_run_flusher, args=(interval,), name='racesow-counters')
+    thread.daemon = True
+    thread.start()
+
+
+def _run_flusher(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush()
+        except Exception:
+            logger.exception('flushing counters failed')
+        finally:
+            # the thread has its own database connection, don't keep it open while sleeping
+            connection.close()
+
+
+atexit.register(flush)
@@ -0,0 +1,177 @@
+"""
+Benchmarks the points engine entry points on a synthetic Racesow dataset
+
+Generates maps, players and races at the requested scale, then reports wall
+time, SQL query count, write statements and changed rows for every entry
+point. Results are appended to a JSON file and compared with the previous run
+of the same scale, so regressions show up between runs.
+
+Usage (see mgxrace/settings_bench.py for setting up the database):
+    python manage.py benchmark_points --maps 1000 --players 100000 --races 2000000 \
+        --settings=mgxrace.settings_bench
+"""
+import json
+import os
+import random
+import re
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from racesow import services, tasks
+from racesow.models import Map, Player, Race
+
+BATCH_SIZE = 1000  # maximum number of rows per bulk INSERT when generating data, lower if the backend requires
+SAMPLE_MAPS = 10  # number of (most played) maps the per-map entry points are run on
+REGRESSION_THRESHOLD = 1.1  # report entry points that became 10% slower
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+SQLITE_QUERY_PREFIX = re.compile(r'''^QUERY = u?['"]''')  # SQLite logs statements as "QUERY = u'...' - PARAMS = ..."
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the points engine on a synthetic dataset'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--maps', type='int', default=100, help='Number of maps to generate'),
+        make_option('--players', type='int', default=1000, help='Number of players to generate'),
+        make_option('--races', type='int', default=20000, help='Number of races to generate'),
+        make_option('--seed', type='int', default=0, help='Seed for the random data generator'),
+        make_option('--reuse', action='store_true', default=False,
+                    help='Benchmark the data already in the database instead of generating new data'),
+        make_option('--output', default='bench_results.json', help='File to append the results to'),
+        make_option('--label', default='', help='Label stored with the results of this run'),
+    )
+
+    def handle(self, *args, **options):
+        if options['reuse']:
+            scale = {'maps': Map.objects.count(), 'players': Player.objects.count(), 'races': Race.objects.count()}
+        elif Map.objects.exists():
+            raise CommandError('Database already contains maps, use --reuse to benchmark the existing data')
+        else:
+            scale = self.generate(options['maps'], options['players'], options['races'], options['seed'])
+        self.stdout.write('Dataset: {maps} maps, {players} players, {races} races'.format(**scale))
+
+        sample = list(Map.objects.order_by('-races').values_list('id', flat=True)[:SAMPLE_MAPS])
+        results = {}
+
+        best_races = dict((mid, list(Race.objects.filter(map__id=mid, time__isnull=False).order_by('time')
+                                     .values_list('id', flat=True)[:1])) for mid in sample)
+
+        def rec_value():
+            for mid, best_race in best_races.items():
+                if best_race:
+                    services.map_get_rec_value(mid, best_race[0])
+
+        def evaluate(engine):
+            def run():
+                for mid in sample:
+                    services.map_evaluate_points(mid, reset=False, engine=engine)
+            return run
+
+        results['map_get_rec_value'] = self.measure(rec_value)
+        results['map_evaluate_points[loop]'] = self.measure(evaluate(services.ENGINE_LOOP))
+        results['map_evaluate_points[bulk]'] = self.measure(evaluate(services.ENGINE_BULK))
+        results['reconcile_player_totals'] = self.measure(services.reconcile_player_totals)
+        results['force_recompute_all'] = self.measure(tasks.force_recompute_all)
+
+        for name in sorted(results):
+            self.stdout.write('{:<28} {seconds:>9.3f}s {queries:>8} queries {writes:>8} writes {rows:>9} rows'
+                              .format(name, **results[name]))
+
+        self.save(options['output'], options['label'], scale, results)
+
+    def generate(self, num_maps, num_players, num_races, seed):
+        """Inserts maps, players and races, with map popularity following a long tail distribution."""
+        rnd = random.Random(seed)
+        now = timezone.now()
+
+        self.bulk_create(Player, [
+            Player(username='bench{}'.format(i), name='bench{}'.format(i), simplified='bench{}'.format(i))
+            for i in range(num_players)
+        ])
+        self.bulk_create(Map, [Map(name='bench_map{}'.format(i)) for i in range(num_maps)])
+        player_ids = list(Player.objects.values_list('id', flat=True))
+        map_ids = list(Map.objects.values_list('id', flat=True))
+
+        weights = [1.0 / (i + 1) for i in range(num_maps)]
+        total_weight = sum(weights)
+
+        races = []
+        for mid, weight in zip(map_ids, weights):
+            count = min(num_players, max(1, int(num_races * weight / total_weight)))
+            best_time = rnd.randint(5000, 120000)
+            for pid in rnd.sample(player_ids, count):
+                finished = rnd.random() < 0.9
+                races.append(Race(player_id=pid, map_id=mid, points=-1000, created=now, last_played=now,
+                                  time=best_time + int(rnd.expovariate(1.0 / best_time)) if finished else None,
+                                  playtime=int(rnd.expovariate(1.0 / 900000))))
+            Map.objects.filter(pk=mid).update(races=count)
+
+            if len(races) >= BATCH_SIZE:
+                self.bulk_create(Race, races)
+                races = []
+        self.bulk_create(Race, races)
+
+        return {'maps': num_maps, 'players': num_players, 'races': Race.objects.count()}
+
+    def bulk_create(self, model, objs):
+        # Django does not cap an explicit batch_size to the limits of the backend (e.g. 999 variables in SQLite)
+        batch_size = min(BATCH_SIZE, connection.ops.bulk_batch_size(model._meta.local_fields, objs) or BATCH_SIZE)
+        model.objects.bulk_create(objs, batch_size=batch_size)
+
+    def measure(self, func):
+        """Runs func and rolls back its changes, so every entry point starts from the same data."""
+        with transaction.atomic():
+            sid = transaction.savepoint()
+            before = self.snapshot()
+            with CaptureQueriesContext(connection) as queries:
+                start = time.time()
+                func()
+                seconds = time.time() - start
+            after = self.snapshot()
+            transaction.savepoint_rollback(sid)
+
+        return {
+            'seconds': seconds,
+            'queries': len(queries),
+            'writes': len([q for q in queries if self.is_write(q['sql'])]),
+            'rows': len([key for key, value in after.iteritems() if before.get(key) != value]),
+        }
+
+    def is_write(self, sql):
+        sql = SQLITE_QUERY_PREFIX.sub('', sql.lstrip())
+        return sql.lstrip().upper().startswith(WRITE_STATEMENTS)
+
+    def snapshot(self):
+        rows = {}
+        for pk, points, rank in Race.objects.values_list('id', 'points', 'rank').iterator():
+            rows[('race', pk)] = (points, rank)
+        for pk, points, maps_finished in Player.objects.values_list('id', 'points', 'maps_finished').iterator():
+            rows[('player', pk)] = (points, maps_finished)
+        return rows
+
+    def save(self, output, label, scale, results):
+        runs = []
+        if os.path.exists(output):
+            with open(output) as f:
+                runs = json.load(f)
+
+        previous = [run for run in runs if run['scale'] == scale]
+        if previous:
+            for name, result in sorted(results.items()):
+                old = previous[-1]['results'].get(name)
+                if not old:
+                    continue
+                if result['seconds'] > old['seconds'] * REGRESSION_THRESHOLD or result['queries'] > old['queries']:
+                    self.stdout.write('Regression in {}: {:.3f}s -> {:.3f}s, {} -> {} queries'.format(
+                        name, old['seconds'], result['seconds'], old['queries'], result['queries']))
+
+        runs.append({'label': label, 'date': timezone.now().isoformat(), 'scale': scale, 'results': results})
+        with open(output, 'w') as f:
+            json.dump(runs, f, indent=2, sort_keys=True)
+        self.stdout.write('Results saved to {}'.format(output))
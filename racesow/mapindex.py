@@ -0,0 +1,104 @@
+"""
+In-memory index of the enabled maps, their names and their tags, used for filtering map lists
+
+Tags are stored as bitsets of map ids (bit i set for map id i), so the maps having all of a set of tags are found by
+intersecting integers instead of joining the tag table once per tag. Name patterns are regular expressions (as sent
+by the game servers), matched case-insensitively anywhere in the name. Prefix patterns ('^abc') are looked up in a
+sorted name list, and the literal parts of substring and wildcard patterns ('abc', 'ab.*cd') narrow the candidates
+through a trigram index before the regular expression is run on the remaining names.
+
+The index is kept per process and rebuilt when the map list generation of racesow.cache changes, i.e. after maps or
+tags were edited.
+"""
+import bisect
+import re
+
+from racesow import cache
+from racesow.models import Map
+
+NGRAM_SIZE = 3
+MAX_CACHED_SEARCHES = 1000  # results of searches remembered per index
+
+# patterns made of literal characters and '.*' wildcards, optionally anchored
+_wildcard_re = re.compile(r'^\^?(?:[^\\.^$|?*+()\[\]{}]|\.\*)*\$?$')
+_prefix_re = re.compile(r'^\^[^\\.^$|?*+()\[\]{}]+$')
+
+_index = None
+
+
+class MapIndex(object):
+    """Enabled maps ordered by name, with bitsets of the maps per tag and per trigram of their names"""
+
+    def __init__(self, generation):
+        self.generation = generation
+        maps = list(Map.objects.filter(enabled=True).order_by('name').values_list('id', 'name'))
+        self.ordered = [mid for mid, name in maps]
+        self.names = dict((mid, name.lower()) for mid, name in maps)
+        self.sorted_names = sorted((name, mid) for mid, name in self.names.items())
+
+        self.ngrams = {}
+        for mid, name in self.names.items():
+            for ngram in set(name[i:i + NGRAM_SIZE] for i in range(len(name) - NGRAM_SIZE + 1)):
+                self.ngrams[ngram] = self.ngrams.get(ngram, 0) | (1 << mid)
+
+        self.tags = {}
+        for mid, name in Map.tags.through.objects.values_list('map_id', 'tag__name'):
+            name = name.lower()
+            self.tags[name] = self.tags.get(name, 0) | (1 << mid)
+
+        self._searches = {}
+
+    def search(self, tags, pattern=''):
+        """Returns the ids of the enabled maps having all tags and a name matching the pattern, ordered by map name
+
+        :raises re.error: if the pattern is not a valid regular expression
+        """
+        key = (pattern, frozenset(tag.lower() for tag in tags))
+        if key not in self._searches:
+            if len(self._searches) >= MAX_CACHED_SEARCHES:
+                self._searches.clear()
+            self._searches[key] = self._search(key[1], pattern)
+        return list(self._searches[key])
+
+    def _search(self, tags, pattern):
+        bits = -1  # all bits set
+        for tag in tags:
+            bits &= self.tags.get(tag, 0)
+        if pattern:
+            bits &= self._candidates(pattern.lower())
+        if not bits:
+            return []
+
+        mids = [mid for mid in self.ordered if bits >> mid & 1]
+        if pattern and not _prefix_re.match(pattern):
+            # the candidates contain all literal parts of the pattern, check the rest of it
+            regex = re.compile(pattern, re.IGNORECASE)
+            mids = [mid for mid in mids if regex.search(self.names[mid])]
+        return mids
+
+    def _candidates(self, pattern):
+        """Returns the bitset of the maps that can match the pattern, all bits set if the pattern has no usable parts"""
+        if _prefix_re.match(pattern):
+            prefix = pattern[1:]
+            bits = 0
+            for name, mid in self.sorted_names[bisect.bisect_left(self.sorted_names, (prefix,)):]:
+                if not name.startswith(prefix):
+                    break
+                bits |= 1 << mid
+            return bits
+
+        bits = -1
+        if _wildcard_re.match(pattern):
+            for literal in pattern.strip('^$').split('.*'):
+                for i in range(len(literal) - NGRAM_SIZE + 1):
+                    bits &= self.ngrams.get(literal[i:i + NGRAM_SIZE], 0)
+        return bits
+
+
+def get_index():
+    """Returns the index of this process, rebuilt if maps or tags changed since it was built"""
+    global _index
+    generation = cache.get_map_list_generation()
+    if _index is None or _index.generation != generation:
+        _index = MapIndex(generation)
+    return _index
@@ -1,9 +1,63 @@
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
 from django.utils import timezone
 import pytz
+from . import cache
 from .models import Server
 from .utils import authenticate
 from django.core.exceptions import PermissionDenied
 
+MAX_VERIFIED_TOKENS = 10000  # verified tokens remembered per process before expired ones are pruned
+
+_servers = {}  # server id -> (Server, time.time() at which it has to be reloaded, generation it was loaded at)
+_verified = {}  # (server id, auth key, uTime, token) -> time.time() until which it is accepted without hashing
+
+
+def get_server(sid):
+    """Returns Server 'sid', cached in this process for settings.SERVER_CACHE_TTL seconds or until it is edited"""
+    now = time.time()
+    # the generation is shared by all processes, so an edit in one of them reaches the others
+    generation = cache.get_server_generation(sid)
+    cached = _servers.get(sid)
+    if cached is not None and cached[1] > now and cached[2] == generation:
+        return cached[0]
+
+    server = Server.objects.get(id=sid)
+    _servers[sid] = (server, now + settings.SERVER_CACHE_TTL, generation)
+    return server
+
+
+def is_authentic(server, u_time, token):
+    """Checks the token of a request, remembering valid tokens for settings.SERVER_TOKEN_REPLAY_WINDOW seconds"""
+    now = time.time()
+    # the auth key is part of the key, so tokens of a replaced key are never accepted
+    key = (server.id, server.auth_key, u_time, token)
+    if _verified.get(key, 0) > now:
+        return True
+
+    if not authenticate(u_time, server.auth_key, token):
+        return False
+
+    if len(_verified) >= MAX_VERIFIED_TOKENS:
+        for verified_key, expires in _verified.items():
+            if expires <= now:
+                _verified.pop(verified_key, None)
+        if len(_verified) >= MAX_VERIFIED_TOKENS:
+            _verified.clear()
+    _verified[key] = now + settings.SERVER_TOKEN_REPLAY_WINDOW
+    return True
+
+
+def forget_server(sender, instance, **kwargs):
+    """Drops a server from the caches of all processes when it is edited or deleted"""
+    _servers.pop(instance.id, None)
+    cache.invalidate_server(instance.id)
+
+post_save.connect(forget_server, sender=Server)
+post_delete.connect(forget_server, sender=Server)
+
 
 class ServerAuthenticationMiddleware(object):
     """
@@ -27,8 +81,8 @@ class ServerAuthenticationMiddleware(object):
 
         # Validate the token
         try:
-            server = Server.objects.get(id=sid)
-            assert authenticate(uTime, server.auth_key, token)
+            server = get_server(int(sid))
+            assert is_authentic(server, uTime, token)
         except:
             raise PermissionDenied
 
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'DirtyMap'
+        db.create_table(u'racesow_dirtymap', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('map', self.gf('django.db.models.fields.related.OneToOneField')(to=orm['racesow.Map'], unique=True)),
+            ('queued', self.gf('django.db.models.fields.DateTimeField')(default=datetime.datetime.now)),
+            ('updated', self.gf('django.db.models.fields.DateTimeField')(default=datetime.datetime.now)),
+        ))
+        db.send_create_signal(u'racesow', ['DirtyMap'])
+
+        # Queue maps that were still flagged for computation of points
+        if not db.dry_run:
+            now = datetime.datetime.now()
+            db.execute(u'INSERT INTO racesow_dirtymap (map_id, queued, updated) '
+                       u'SELECT id, %s, %s FROM racesow_map WHERE compute_points', [now, now])
+
+        # Deleting field 'Map.compute_points'
+        db.delete_column(u'racesow_map', 'compute_points')
+
+
+    def backwards(self, orm):
+        # Adding field 'Map.compute_points'
+        db.add_column(u'racesow_map', 'compute_points',
+                      self.gf('django.db.models.fields.BooleanField')(default=False),
+                      keep_default=False)
+
+        # Flag queued maps for computation of points
+        if not db.dry_run:
+            db.execute(u'UPDATE racesow_map SET compute_points = 1 '
+                       u'WHERE id IN (SELECT map_id FROM racesow_dirtymap)')
+
+        # Deleting model 'DirtyMap'
+        db.delete_table(u'racesow_dirtymap')
+
+
+    models = {
+        u'racesow.checkpoint': {
+            'Meta': {'unique_together': "(('race', 'number'),)", 'object_name': 'Checkpoint'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'number': ('django.db.models.fields.IntegerField', [], {}),
+            'race': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Race']"}),
+            'time': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'racesow.dirtymap': {
+            'Meta': {'object_name': 'DirtyMap'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'map': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['racesow.Map']", 'unique': 'True'}),
+            'queued': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'})
+        },
+        u'racesow.map': {
+            'Meta': {'object_name': 'Map'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_computation': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'levelshotfile': ('django.db.models.fields.files.FileField', [], {'max_length': '100', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'oneliner': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'pk3file': ('django.db.models.fields.files.FileField', [], {'max_length': '100', 'blank': 'True'}),
+            'playtime': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'races': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'tags': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['racesow.Tag']", 'symmetrical': 'False'})
+        },
+        u'racesow.maprating': {
+            'Meta': {'unique_together': "(('user', 'map'),)", 'object_name': 'MapRating'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'map': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Map']"}),
+            'rating': ('django.db.models.fields.IntegerField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Player']"})
+        },
+        u'racesow.player': {
+            'Meta': {'object_name': 'Player'},
+            'admin': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'maps': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'maps_finished': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'playtime': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'points': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'races': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'simplified': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'})
+        },
+        u'racesow.playerhistory': {
+            'Meta': {'object_name': 'PlayerHistory'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'maps': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'playtime': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'races': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'simplified': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'username': ('django.db.models.fields.CharField', [], {'max_length': '64'})
+        },
+        u'racesow.race': {
+            'Meta': {'unique_together': "(('player', 'map'),)", 'object_name': 'Race'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_played': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'map': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Map']"}),
+            'player': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Player']"}),
+            'playtime': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'points': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'rank': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'server': ('django.db.models.fields.related.ForeignKey', [], {'default': 'None', 'to': u"orm['racesow.Server']", 'null': 'True', 'on_delete': 'models.SET_NULL', 'blank': 'True'}),
+            'time': ('django.db.models.fields.IntegerField', [], {'default': 'None', 'null': 'True', 'blank': 'True'})
+        },
+        u'racesow.racehistory': {
+            'Meta': {'object_name': 'RaceHistory'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_played': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'map': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Map']"}),
+            'player': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Player']"}),
+            'playtime': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'points': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'rank': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'server': ('django.db.models.fields.related.ForeignKey', [], {'default': 'None', 'to': u"orm['racesow.Server']", 'null': 'True', 'on_delete': 'models.SET_NULL', 'blank': 'True'}),
+            'time': ('django.db.models.fields.IntegerField', [], {'default': 'None', 'null': 'True', 'blank': 'True'})
+        },
+        u'racesow.server': {
+            'Meta': {'object_name': 'Server'},
+            'address': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'auth_key': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_seen': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'players': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'playtime': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'races': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'simplified': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'default': 'None', 'to': u"orm['racesow.Player']", 'null': 'True', 'on_delete': 'models.SET_NULL', 'blank': 'True'})
+        },
+        u'racesow.tag': {
+            'Meta': {'object_name': 'Tag'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '15'})
+        }
+    }
+
+    complete_apps = ['racesow']
\ No newline at end of file
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import struct
+
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+CHUNK_SIZE = 10000  # number of race ids of which the checkpoints are converted at once
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'Race.checkpoints'
+        db.add_column(u'racesow_race', 'checkpoints',
+                      self.gf('django.db.models.fields.BinaryField')(default=None, null=True, blank=True),
+                      keep_default=False)
+
+        # Adding field 'RaceHistory.checkpoints'
+        db.add_column(u'racesow_racehistory', 'checkpoints',
+                      self.gf('django.db.models.fields.BinaryField')(default=None, null=True, blank=True),
+                      keep_default=False)
+
+        # Pack the existing Checkpoint rows into Race.checkpoints, streaming them per chunk of race ids
+        if not db.dry_run:
+            last_id = orm['racesow.Checkpoint'].objects.aggregate(last=models.Max('race'))['last'] or 0
+            for start in range(0, last_id + 1, CHUNK_SIZE):
+                times = {}
+                for race_id, time in orm['racesow.Checkpoint'].objects.filter(
+                        race__gte=start, race__lt=start + CHUNK_SIZE).order_by('race', 'number')\
+                        .values_list('race', 'time'):
+                    times.setdefault(race_id, []).append(time)
+                for race_id, race_times in times.items():
+                    orm['racesow.Race'].objects.filter(pk=race_id).update(
+                        checkpoints=struct.pack('<{}i'.format(len(race_times)), *race_times))
+
+    def backwards(self, orm):
+        # Unpack Race.checkpoints into Checkpoint rows again. The frozen ORM of the previous migration has no
+        # checkpoints field, so the column is read with plain SQL
+        if not db.dry_run:
+            last_id = db.execute('SELECT MAX(id) FROM racesow_race WHERE checkpoints IS NOT NULL')[0][0] or 0
+            for start in range(0, last_id + 1, CHUNK_SIZE):
+                packed = dict(db.execute('SELECT id, checkpoints FROM racesow_race '
+                                         'WHERE checkpoints IS NOT NULL AND id >= %s AND id < %s',
+                                         [start, start + CHUNK_SIZE]))
+                orm['racesow.Checkpoint'].objects.filter(race__in=list(packed)).delete()
+                orm['racesow.Checkpoint'].objects.bulk_create([
+                    orm['racesow.Checkpoint'](race_id=race_id, number=number, time=time)
+                    for race_id, data in packed.items()
+                    for number, time in enumerate(struct.unpack('<{}i'.format(len(data) // 4), bytes(data)))],
+                    batch_size=1000)
+
+        # Deleting field 'Race.checkpoints'
+        db.delete_column(u'racesow_race', 'checkpoints')
+
+        # Deleting field 'RaceHistory.checkpoints'
+        db.delete_column(u'racesow_racehistory', 'checkpoints')
+
+
+    models = {
+        u'racesow.checkpoint': {
+            'Meta': {'unique_together': "(('race', 'number'),)", 'object_name': 'Checkpoint'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'number': ('django.db.models.fields.IntegerField', [], {}),
+            'race': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Race']"}),
+            'time': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'racesow.dirtymap': {
+            'Meta': {'object_name': 'DirtyMap'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'map': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['racesow.Map']", 'unique': 'True'}),
+            'queued': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'})
+        },
+        u'racesow.map': {
+            'Meta': {'object_name': 'Map'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_computation': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'levelshotfile': ('django.db.models.fields.files.FileField', [], {'max_length': '100', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'oneliner': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'pk3file': ('django.db.models.fields.files.FileField', [], {'max_length': '100', 'blank': 'True'}),
+            'playtime': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'races': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'scored_version': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'tags': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['racesow.Tag']", 'symmetrical': 'False'}),
+            'version': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        },
+        u'racesow.mapsnapshot': {
+            'Meta': {'unique_together': "(('map', 'date', 'rank'),)", 'object_name': 'MapSnapshot'},
+            'date': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'map': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Map']"}),
+            'player': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Player']"}),
+            'points': ('django.db.models.fields.IntegerField', [], {}),
+            'rank': ('django.db.models.fields.IntegerField', [], {}),
+            'time': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'racesow.maprating': {
+            'Meta': {'unique_together': "(('user', 'map'),)", 'object_name': 'MapRating'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'map': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Map']"}),
+            'rating': ('django.db.models.fields.IntegerField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Player']"})
+        },
+        u'racesow.player': {
+            'Meta': {'object_name': 'Player'},
+            'admin': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'maps': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'maps_finished': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'playtime': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'points': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'races': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'simplified': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'})
+        },
+        u'racesow.playerhistory': {
+            'Meta': {'object_name': 'PlayerHistory'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'maps': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'playtime': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'races': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'simplified': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'username': ('django.db.models.fields.CharField', [], {'max_length': '64'})
+        },
+        u'racesow.playersnapshot': {
+            'Meta': {'unique_together': "(('player', 'date'),)", 'object_name': 'PlayerSnapshot'},
+            'date': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'maps_finished': ('django.db.models.fields.IntegerField', [], {}),
+            'player': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Player']"}),
+            'points': ('django.db.models.fields.IntegerField', [], {}),
+            'rank': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'racesow.race': {
+            'Meta': {'unique_together': "(('player', 'map'),)", 'object_name': 'Race'},
+            'checkpoints': ('django.db.models.fields.BinaryField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_played': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'map': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Map']"}),
+            'player': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Player']"}),
+            'playtime': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'points': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'rank': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'server': ('django.db.models.fields.related.ForeignKey', [], {'default': 'None', 'to': u"orm['racesow.Server']", 'null': 'True', 'on_delete': 'models.SET_NULL', 'blank': 'True'}),
+            'time': ('django.db.models.fields.IntegerField', [], {'default': 'None', 'null': 'True', 'blank': 'True'})
+        },
+        u'racesow.racehistory': {
+            'Meta': {'object_name': 'RaceHistory'},
+            'checkpoints': ('django.db.models.fields.BinaryField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_played': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'map': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Map']"}),
+            'player': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['racesow.Player']"}),
+            'playtime': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'points': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'rank': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'server': ('django.db.models.fields.related.ForeignKey', [], {'default': 'None', 'to': u"orm['racesow.Server']", 'null': 'True', 'on_delete': 'models.SET_NULL', 'blank': 'True'}),
+            'time': ('django.db.models.fields.IntegerField', [], {'default': 'None', 'null': 'True', 'blank': 'True'})
+        },
+        u'racesow.server': {
+            'Meta': {'object_name': 'Server'},
+            'address': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'auth_key': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_seen': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'players': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'playtime': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'races': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'simplified': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'default': 'None', 'to': u"orm['racesow.Player']", 'null': 'True', 'on_delete': 'models.SET_NULL', 'blank': 'True'})
+        },
+        u'racesow.tag': {
+            'Meta': {'object_name': 'Tag'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '15'})
+        }
+    }
+
+    complete_apps = ['racesow']
\ No newline at end of file
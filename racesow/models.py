@@ -3,7 +3,7 @@ import datetime
 from django.db import models
 from django.utils import timezone
 
-from racesow.utils import username_with_html_colors, millis_to_str
+from racesow.utils import username_with_html_colors, millis_to_str, pack_checkpoints, unpack_checkpoints
 
 
 _null = {'blank': True, 'null': True, 'default': None}
@@ -63,7 +63,6 @@ class Map(models.Model):
         created (datetime): Datetime map was added
         oneliner (str): Oneliner message for the map
         tags (RelatedManager): Manager for Tag objects associated with the map
-        compute_points (bool): True if the map has new race times or playtimes
         last_computation (datetime): last computation of points for races on this map
     """
     name = models.CharField(max_length=255, unique=True)
@@ -75,7 +74,6 @@ class Map(models.Model):
     created = models.DateTimeField(default=timezone.now)
     oneliner = models.CharField(max_length=255, blank=True)
     tags = models.ManyToManyField(Tag)
-    compute_points = models.BooleanField(default=False)
     last_computation = models.DateTimeField(default=timezone.now)
 
     def __unicode__(self):
@@ -89,6 +87,44 @@ class Map(models.Model):
     get_tags.short_description = 'Tags'
 
 
+class DirtyMap(models.Model):
+    """Queue of maps with new race times or playtimes, awaiting computation of points
+
+    A map is queued at most once. Its recomputation is dispatched once it has
+    been quiet for a while, see racesow.services.claim_dirty_maps.
+
+    Model Fields:
+        map (Map): Map to compute points for
+        queued (datetime): Date/time the map was first queued
+        updated (datetime): Date/time the map was last marked dirty
+    """
+    map = models.OneToOneField(Map)
+    queued = models.DateTimeField(default=timezone.now)
+    updated = models.DateTimeField(default=timezone.now)
+
+    def __unicode__(self):
+        return '<DirtyMap map:{}, updated:{}>'.format(self.map_id, self.updated)
+
+
+class MapVersion(models.Model):
+    """Ingestion version of a map, compared-and-swapped by the computation of points
+
+    Kept apart from Map so that storing races does not write the map row, which is read by every request for the
+    map. See racesow.services.map_score.
+
+    Model Fields:
+        map (Map): Map the version belongs to
+        version (int): ingestion version, incremented whenever races or playtimes are stored for the map
+        scored_version (int): ingestion version the current points of the races on this map were computed for
+    """
+    map = models.OneToOneField(Map, primary_key=True)
+    version = models.IntegerField(default=0)
+    scored_version = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return '<MapVersion map:{}, version:{}, scored:{}>'.format(self.map_id, self.version, self.scored_version)
+
+
 class MapRating(models.Model):
     """Racesow Map Rating Model
 
@@ -194,6 +230,8 @@ class RaceHistory(models.Model):
         rank (int): The place that the racetime took on the map toplist
         created (datetime): Datetime when the record was made
         last_played (datetime): Datetime when the playtime stats were updated
+        checkpoints (bytes): Checkpoint times packed as little-endian int32 array, see get_checkpoints. Null for
+                             history from before checkpoints were packed.
     """
     player = models.ForeignKey(Player)
     map = models.ForeignKey(Map)
@@ -204,11 +242,21 @@ class RaceHistory(models.Model):
     rank = models.IntegerField(default=0)
     created = models.DateTimeField(default=timezone.now)
     last_played = models.DateTimeField(default=timezone.now)
+    checkpoints = models.BinaryField(**_null)
 
     def __unicode__(self):
         return 'player: {}, map: {}, time: {}'.format(self.player.simplified,
                                                       self.map.name, self.time)
 
+    def get_checkpoints(self):
+        # unpack the checkpoint times, None if they were not recorded
+        if self.checkpoints is None:
+            return None
+        return unpack_checkpoints(self.checkpoints)
+
+    def set_checkpoints(self, times):
+        self.checkpoints = pack_checkpoints(times)
+
 
 class Race(models.Model):
     """Racesow Race Model
@@ -229,6 +277,8 @@ class Race(models.Model):
                     Updated during point calculation.
         created (datetime): Datetime when the record was made
         last_played (datetime): Datetime when the playtime stats were updated
+        checkpoints (bytes): Checkpoint times packed as little-endian int32 array, see get_checkpoints. Null for
+                             races of which the checkpoints are stored as Checkpoint rows.
     """
     player = models.ForeignKey(Player)
     map = models.ForeignKey(Map)
@@ -239,14 +289,26 @@ class Race(models.Model):
     rank = models.IntegerField(default=0)
     created = models.DateTimeField(default=timezone.now)
     last_played = models.DateTimeField(default=timezone.now)
+    checkpoints = models.BinaryField(**_null)
 
     class Meta:
         unique_together = ('player', 'map')
+        # toplists of a map, see services.map_assign_ranks
+        index_together = [('map', 'time')]
 
     def __unicode__(self):
         return 'player: {}, map: {}, time: {}'.format(self.player.simplified,
                                                       self.map.name, self.time)
 
+    def get_checkpoints(self):
+        # unpack the checkpoint times, None if they are stored as Checkpoint rows
+        if self.checkpoints is None:
+            return None
+        return unpack_checkpoints(self.checkpoints)
+
+    def set_checkpoints(self, times):
+        self.checkpoints = pack_checkpoints(times)
+
     def time_formatted(self):
         return millis_to_str(int(self.time))
 
@@ -286,3 +348,86 @@ class Checkpoint(models.Model):
     def __unicode__(self):
         return '<player: {}, map: {}, cpNum: {}>'.format(
             self.race.player.simplified, self.race.map.name, self.number)
+
+
+class RaceSubmission(models.Model):
+    """Racesow Race Submission Model
+
+    A race posted by a game server that is stored asynchronously. The key is chosen by the server, so a post that is
+    retried after a timeout finds the submission of the first attempt instead of storing the race twice.
+
+    Model Fields:
+        server (Server): Server that submitted the race
+        key (str): Idempotency key, unique per server
+        payload (str): JSON of the submitted race (pid, mid, time, checkpoints, co)
+        created (datetime): Datetime when the race was submitted
+        applied (datetime): Datetime when the race was stored, null while it is pending
+    """
+    server = models.ForeignKey(Server)
+    key = models.CharField(max_length=64)
+    payload = models.TextField()
+    created = models.DateTimeField(default=timezone.now)
+    applied = models.DateTimeField(**_null)
+
+    class Meta:
+        unique_together = ('server', 'key')
+
+    def __unicode__(self):
+        return '<RaceSubmission server:{}, key:{}>'.format(self.server_id, self.key)
+
+
+class PlayerSnapshot(models.Model):
+    """Racesow Player Snapshot Model
+
+    Daily snapshot of a player's position on the points leaderboard
+
+    Model Fields:
+        player (Player): Player the snapshot was taken of
+        date (date): Day of the snapshot
+        points (int): Total number of points of the player, in thousands
+        rank (int): Position of the player on the points leaderboard
+        maps_finished (int): Number of maps the player has completed a race on
+    """
+    player = models.ForeignKey(Player)
+    date = models.DateField(db_index=True)
+    points = models.IntegerField()
+    rank = models.IntegerField()
+    maps_finished = models.IntegerField()
+
+    class Meta:
+        unique_together = ('player', 'date')
+
+    def __unicode__(self):
+        return '<PlayerSnapshot player:{}, date:{}, rank:{}>'.format(self.player_id, self.date, self.rank)
+
+    def get_points(self):
+        # transform points back to float with 3 decimals
+        return float(self.points / 1000.0)
+
+
+class MapSnapshot(models.Model):
+    """Racesow Map Snapshot Model
+
+    Daily snapshot of the top races on a map
+
+    Model Fields:
+        map (Map): Map the snapshot was taken of
+        date (date): Day of the snapshot
+        rank (int): Position of the race on the map toplist, races with equal times share a rank
+        player (Player): Player who performed the race
+        time (int): Time of the race in milliseconds
+        points (int): Points awarded to the race, in thousands
+    """
+    map = models.ForeignKey(Map)
+    date = models.DateField(db_index=True)
+    rank = models.IntegerField()
+    player = models.ForeignKey(Player)
+    time = models.IntegerField()
+    points = models.IntegerField()
+
+    class Meta:
+        unique_together = ('map', 'date', 'player')
+
+    def __unicode__(self):
+        return '<MapSnapshot map:{}, date:{}, rank:{}>'.format(self.map_id, self.date, self.rank)
+
@@ -92,7 +92,13 @@ def raceSerializer(race):
     if timezone.is_aware(created):
         created = timezone.localtime(created, timezone=timezone.utc)
 
-    cp_set = race.checkpoint_set.all()
+    checkpoints = race.get_checkpoints()
+    if checkpoints is None:
+        # checkpoints stored before they were packed into the race
+        checkpoints = [checkpointSerializer(cp) for cp in race.checkpoint_set.all()]
+    else:
+        checkpoints = [{'id': None, 'raceId': race.id, 'number': number, 'time': time}
+                       for number, time in enumerate(checkpoints)]
 
     return {
         'id': race.id,
@@ -103,7 +109,7 @@ def raceSerializer(race):
         'playtime': race.playtime,
         'points': race.get_points(),
         'created': created.strftime("%Y-%m-%d - %H:%M:%S"),
-        'checkpoints': [checkpointSerializer(cp) for cp in cp_set]
+        'checkpoints': checkpoints
     }
 
 
@@ -1,17 +1,24 @@
 # methods for performing business logic; reduces complexity of views
 import re
 import datetime
+import json
 
-from djcelery.models import PeriodicTask, IntervalSchedule, TaskState
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
 
-from racesow.models import Race
+from racesow.models import (Checkpoint, DirtyMap, Map, MapSnapshot, MapVersion, Player, PlayerSnapshot, Race,
+                            RaceHistory, RaceSubmission)
+from racesow.cache import invalidate_map, invalidate_records, race_stored
 from racesow.serializers import raceSerializer
-from racesow.utils import average, floats_differ
+from racesow.utils import average, floats_differ, pack_checkpoints
 
 MIN_REC_POINTS = 2
 MAX_REC_POINTS = 100
 SECOND_PLACE_PERC = 0.9  # 90% of 1st place
 SKIP_BUMPTIME_OFFSET = 20  # number of completed races required for
+TOP_AVERAGE_SIZE = 20  # number of best racetimes averaged for scaling the points of 2nd place and below
 
 # define playtime bumps for maps with fewer entries
 BUMPTIME_LOW = 600000  # 10 minutes in millis
@@ -24,52 +31,76 @@ BUMP_POINTS = {
     BUMPTIME_HIGH: 10,
 }
 
+# points engines selectable through settings.POINTS_ENGINE
+ENGINE_LOOP = 'loop'  # evaluates and saves every race/player one by one
+ENGINE_BULK = 'bulk'  # evaluates the map in memory and writes back changed rows in bulk statements
+
+BULK_UPDATE_BATCH_SIZE = 500  # max number of rows per bulk UPDATE statement
+SNAPSHOT_BATCH_SIZE = 1000  # max number of rows per bulk INSERT of leaderboard snapshots
+MAP_SNAPSHOT_SIZE = 10  # number of top races stored per map in the daily snapshots
+RACE_BATCH_INSERT_SIZE = 1000  # max number of rows per bulk INSERT when storing a batch of races
+RACE_SUBMISSION_RETENTION = 7  # number of days applied race submissions are kept for detecting retries
+RACE_SUBMISSION_RETRY_DELAY = 60  # number of seconds after which a pending race submission is queued again
+
 _playerre = re.compile(r'player($|\(\d*\))', flags=re.IGNORECASE)
 
 
-def map_get_rec_value(num_completed_races, races, best_race):
+def map_get_rec_value(mid, best_race_id):
     """Compute the number of points to award the 1st player. It considers the amount of playtime other players spent on
      the map, the general idea being: more playtime && more players --> more points for 1st place.
 
-    :param num_completed_races: number of Race objects with a time
-    :param races: array of Race objects, sorted by playtime (desc)
+    :param mid: map to compute the rec value of
+    :param best_race_id: id of the fastest race on the map
     :return: points to award to 1st place (value between MIN_REC_POINTS and MAX_REC_POINTS)
     """
 
-    # determine rec points from playtimes
-    rec_points = MIN_REC_POINTS
+    # The fastest player cannot increase his own score by playing longer. On the contrary: the more he
+    # plays, the more he bumps the score in case another player takes the rec. As points are always
+    # calculated from scratch, the rec will be worth less when he re-recs because his own playtime is once
+    # again excluded.
+    buckets = map_count_playtime_buckets(mid, best_race_id)
 
     # bump rec_points for every player with significant playtime on this map
-    for race in races:
-        if race.pk == best_race.pk:
-            # The fastest player cannot increase his own score by playing longer. On the contrary: the more he
-            # plays, the more he bumps the score in case another player takes the rec. As points are always
-            # calculated from scratch, the rec will be worth less when he re-recs because his own playtime is once
-            # again excluded.
-            continue
-
-        if race.playtime > BUMPTIME_HIGH:
-            rec_points += BUMP_POINTS[BUMPTIME_HIGH]
-        elif race.playtime > BUMPTIME_MEDIUM:
-            rec_points += BUMP_POINTS[BUMPTIME_MEDIUM]
-        elif race.playtime > BUMPTIME_LOW:
-            rec_points += BUMP_POINTS[BUMPTIME_LOW]
-        else:
-            # no significant Race objects left, break loop
-            break
+    rec_points = MIN_REC_POINTS
+    for bumptime, count in buckets.items():
+        rec_points += BUMP_POINTS[bumptime] * count
 
     # check whether we are not exceeding maximum value
     return min(rec_points, MAX_REC_POINTS)
 
 
-def _update_points(race, new_points, race_rank, reset):
+def map_count_playtime_buckets(mid, exclude_race_id):
+    """Counts the races on a map per playtime bucket, using a single conditional COUNT query.
+
+    :param mid: map to count the races of
+    :param exclude_race_id: race to leave out of the counts (the best race)
+    :return: dict of BUMPTIME_HIGH/MEDIUM/LOW -> number of races with a playtime above that bumptime, but not above
+             the next higher one
+    """
+    qn = connection.ops.quote_name
+    playtime = qn(Race._meta.get_field('playtime').column)
+    bucket = 'COUNT(CASE WHEN {0} > %s AND {0} <= %s THEN 1 END)'.format(playtime)
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(CASE WHEN {} > %s THEN 1 END), {}, {} FROM {} WHERE {} = %s AND {} <> %s'.format(
+        playtime, bucket, bucket, qn(Race._meta.db_table), qn(Race._meta.get_field('map').column),
+        qn(Race._meta.pk.column)),
+        [BUMPTIME_HIGH, BUMPTIME_MEDIUM, BUMPTIME_HIGH, BUMPTIME_LOW, BUMPTIME_MEDIUM, mid, exclude_race_id])
+    high, medium, low = cursor.fetchone()
+    return {BUMPTIME_HIGH: int(high), BUMPTIME_MEDIUM: int(medium), BUMPTIME_LOW: int(low)}
+
+
+def _update_points(race, new_points, race_rank, reset, update_players=True):
     # save old points value for updating the player totals
     old_points = race.get_points()
 
     # award points for the player's race
     race.set_points(new_points)
     race.rank = race_rank  # set rank (for medals)
-    race.save()
+    race.save(update_fields=['points', 'rank'])
+
+    if not update_players:
+        # player totals are reconciled afterwards, see reconcile_player_totals
+        return
 
     if reset:
         # race & player points were reset, update player's total points and maps_finished
@@ -86,40 +117,297 @@ def _update_points(race, new_points, race_rank, reset):
         else:
             # nothing changed for player's total points/maps_finished
             return
-    race.player.save()
+    race.player.save(update_fields=['points', 'maps_finished'])
+
+
+def compute_map_points(times, rec_points):
+    """Computes the points for every completed race on a map in a single pass.
+
+    :param times:       racetimes of the completed races, sorted ascendingly
+    :param rec_points:  points to award to 1st place, see map_get_rec_value
+    :return: list of points, the value at index i being awarded to rank i + 1
+    """
+    if not times:
+        return []
+
+    points = [rec_points]
+    if len(times) == 1:
+        return points
+
+    # same arithmetic as the per-race loop in _map_evaluate_points_loop, so both engines produce identical values
+    top20avg = average(times[:TOP_AVERAGE_SIZE])
+    second_place_cap = min(rec_points - 2, rec_points * SECOND_PLACE_PERC)
+    x = second_place_cap * (7 / 9)
+    first_time = times[0]
+
+    points_above = min(second_place_cap, second_place_cap - (x * ((times[1] - first_time) / (top20avg * 0.8))))
+    points.append(points_above)
+
+    for time in times[2:]:
+        points_above = max(0, min(points_above - 2, second_place_cap -
+                                  (x * ((time - first_time) / (top20avg * 0.8)))))
+        points.append(points_above)
+    return points
+
+
+def dense_ranks(times):
+    """Computes the toplist position of every racetime, equal times sharing a position.
+
+    :param times:   racetimes of the completed races, sorted ascendingly
+    :return: list of ranks, the same ones map_assign_ranks stores in Race.rank
+    """
+    ranks = []
+    for i, time in enumerate(times):
+        if i == 0:
+            ranks.append(1)
+        elif time == times[i - 1]:
+            ranks.append(ranks[-1])
+        else:
+            ranks.append(ranks[-1] + 1)
+    return ranks
+
 
+def map_assign_ranks(mid=None):
+    """Stores the dense toplist position of every completed race in Race.rank.
 
-def map_evaluate_points(mid, reset):
+    The races are read in a single pass ordered by map and time (on the (map, time) index of Race) and only the races
+    whose rank changed are written with bulk_update. This is cheap enough to run right after a race is stored, making
+    the medals correct before the points of the map are evaluated.
+
+    :param mid: map to assign the ranks of, None for all maps
+    :return: number of races whose rank changed
+    """
+    races = Race.objects.filter(time__isnull=False)
+    if mid is not None:
+        races = races.filter(map__id=mid)
+
+    rows = {}
+    current_map = previous_time = None
+    rank = 0
+    for race_id, map_id, time, stored_rank in races.order_by('map', 'time')\
+            .values_list('id', 'map', 'time', 'rank').iterator():
+        if map_id != current_map:
+            current_map, previous_time, rank = map_id, None, 0
+        if time != previous_time:
+            # equal racetimes share a rank
+            previous_time = time
+            rank += 1
+        if rank != stored_rank:
+            rows[race_id] = (rank,)
+
+    bulk_update(Race, rows, ('rank',))
+    return len(rows)
+
+
+def bulk_update(model, rows, fields, increment=False):
+    """Writes different values to many rows of a table using CASE statements, in batches.
+
+    :param model:       model class of the table to update
+    :param rows:        dict of primary key -> tuple of values, one value for each field
+    :param fields:      names of the fields to update
+    :param increment:   True to add the values to the current column values instead of overwriting them
+    :return: number of UPDATE statements executed
+    """
+    qn = connection.ops.quote_name
+    pk_column = qn(model._meta.pk.column)
+    columns = [qn(model._meta.get_field(field).column) for field in fields]
+    pks = list(rows)
+    statements = 0
+    # every row binds its primary key and value once per field plus its primary key in the WHERE clause, stay within
+    # the maximum number of query parameters of the database (999 on SQLite)
+    batch_size = min(BULK_UPDATE_BATCH_SIZE,
+                     connection.ops.bulk_batch_size([None] * (2 * len(fields) + 1), pks) or BULK_UPDATE_BATCH_SIZE)
+
+    cursor = connection.cursor()
+    for start in range(0, len(pks), batch_size):
+        batch = pks[start:start + batch_size]
+        assignments = []
+        params = []
+        for i, column in enumerate(columns):
+            case = 'CASE {} {} END'.format(pk_column, ' '.join(['WHEN %s THEN %s'] * len(batch)))
+            for pk in batch:
+                params.extend([pk, rows[pk][i]])
+            if increment:
+                assignments.append('{0} = {0} + {1}'.format(column, case))
+            else:
+                assignments.append('{} = {}'.format(column, case))
+        params.extend(batch)
+        cursor.execute('UPDATE {} SET {} WHERE {} IN ({})'.format(
+            qn(model._meta.db_table), ', '.join(assignments), pk_column, ', '.join(['%s'] * len(batch))), params)
+        statements += 1
+    return statements
+
+
+def map_evaluate_points(mid, reset, engine=None, update_players=True):
     """Evaluates points awarded to races for map 'mid'.
 
     :param mid:     map to evaluate races of
     :param reset:   True if all points have been reset,
                     False if points should be updated in-place
+    :param engine:  ENGINE_LOOP or ENGINE_BULK, defaults to settings.POINTS_ENGINE
+    :param update_players:  False to leave Player.points and Player.maps_finished untouched, the returned players
+                            should then be passed to reconcile_player_totals
+    :return: set of ids of the players whose race was (re-)evaluated
     """
+    if engine is None:
+        engine = getattr(settings, 'POINTS_ENGINE', ENGINE_BULK)
+
+    if engine == ENGINE_BULK:
+        players = _map_evaluate_points_bulk(mid, reset, update_players)
+    elif engine == ENGINE_LOOP:
+        players = _map_evaluate_points_loop(mid, reset, update_players)
+    else:
+        raise ValueError('Unknown points engine {}'.format(engine))
+
+    # the points of the races changed
+    invalidate_records(mid)
+    return players
 
-    # get Race objects with times (sorted by racetime ascendingly)
-    completed_races = Race.objects.filter(map__id=mid, time__isnull=False).order_by('time')
+
+def _map_evaluate_points_bulk(mid, reset, update_players):
+    """Evaluates points for map 'mid' from a single read of its completed races, writing back only the rows that
+    changed.
+
+    Produces exactly the same Race.points, Race.rank and Player totals as _map_evaluate_points_loop.
+    """
+
+    # (id, player_id, time, points, rank) of races with times (sorted by racetime, equal times by id)
+    completed_races = list(Race.objects.filter(map__id=mid, time__isnull=False).order_by('time', 'id')
+                           .values_list('id', 'player_id', 'time', 'points', 'rank'))
+
+    if not completed_races:
+        # no races to award points
+        return set()
+
+    # determine points for first place from the playtimes of all other races
+    rec_points = map_get_rec_value(mid, completed_races[0][0])
+
+    times = [race[2] for race in completed_races]
+    points = compute_map_points(times, rec_points)
+
+    race_rows = {}
+    player_rows = {}
+    for race, new_points, rank in zip(completed_races, points, dense_ranks(times)):
+        _collect_points_update(race, new_points, rank, reset, race_rows, player_rows)
+    _write_points_updates(race_rows, player_rows if update_players else {})
+    return set(race[1] for race in completed_races if race[0] in race_rows)
+
+
+def _collect_points_update(race, new_points, race_rank, reset, race_rows, player_rows):
+    """Bulk counterpart of _update_points, collecting the changed rows instead of saving them.
+
+    :param race:        (id, player_id, time, points, rank) tuple of the race
+    :param race_rows:   dict of race id -> (points, rank), updated in place
+    :param player_rows: dict of player id -> (points increment, maps_finished increment), updated in place
+    """
+    race_id, player_id, time, stored_points, stored_rank = race
+    new_stored_points = int(new_points * 1000)
+    if new_stored_points != stored_points or race_rank != stored_rank:
+        race_rows[race_id] = (new_stored_points, race_rank)
+
+    # mirror the player total updates of _update_points
+    old_points = float(stored_points / 1000.0)
+    if reset or not floats_differ(old_points, -1):
+        player_rows[player_id] = (int(new_points * 1000), 1)
+    elif floats_differ(new_points, old_points):
+        player_rows[player_id] = (int((new_points - old_points) * 1000), 0)
+
+
+def _write_points_updates(race_rows, player_rows):
+    with transaction.atomic():
+        bulk_update(Race, race_rows, ('points', 'rank'))
+        bulk_update(Player, player_rows, ('points', 'maps_finished'), increment=True)
+
+
+def map_evaluate_race(race_id, old_time):
+    """Re-scores only the ranks of a map that are affected by a new time of race 'race_id'.
+
+    Races above the changed positions keep their points. The window between the old and the new position of the
+    race is re-scored, followed by the races below it until their points match the previous evaluation again.
+    A full map_evaluate_points is done instead when the top TOP_AVERAGE_SIZE moved, as that changes the record,
+    the second place or the top-20 average and thereby the points of every race.
+
+    Player totals of the re-scored races are reconciled afterwards rather than updated with deltas. Ranks outside
+    the window can shift when times start or stop being tied, those are written along with the window.
+
+    :param race_id:     race that got a new time
+    :param old_time:    previous time of the race, None if it had no time yet
+    :return: True if the map was updated incrementally, False if it was fully re-evaluated
+    """
+    race = Race.objects.get(pk=race_id)
+
+    # (id, player_id, time, points, rank) of races with times (sorted by racetime, equal times by id)
+    completed_races = list(Race.objects.filter(map__id=race.map_id, time__isnull=False).order_by('time', 'id')
+                           .values_list('id', 'player_id', 'time', 'points', 'rank'))
+    times = [r[2] for r in completed_races]
+    try:
+        new_rank = [r[0] for r in completed_races].index(race_id) + 1
+    except ValueError:
+        # race has no time (anymore), nothing to do for this race
+        return True
+
+    if old_time is None:
+        old_times = times[:new_rank - 1] + times[new_rank:]
+        window = (new_rank, len(completed_races))
+    else:
+        old_times = sorted(times[:new_rank - 1] + times[new_rank:] + [old_time])
+        old_rank = len([t for t in old_times if t < old_time]) + 1
+        window = (min(new_rank, old_rank), max(new_rank, old_rank))
+
+    # stored points of the record are exactly rec_points * 1000 once the map has been evaluated
+    rec_stored_points = completed_races[0][3]
+    if window[0] <= TOP_AVERAGE_SIZE or rec_stored_points < MIN_REC_POINTS * 1000 or rec_stored_points % 1000:
+        reconcile_player_totals(map_evaluate_points(race.map_id, reset=False, update_players=False))
+        return False
+
+    rec_points = rec_stored_points // 1000
+    points = compute_map_points(times, rec_points)
+    old_points = compute_map_points(old_times, rec_points)
+    ranks = dense_ranks(times)
+
+    race_rows = {}
+    players = set()
+    for rank in range(window[0], len(completed_races) + 1):
+        if rank > window[1] and points[rank - 1] == old_points[rank - 1]:
+            # same races and points as before from here on, the rest of the ranking is unaffected
+            break
+        _collect_points_update(completed_races[rank - 1], points[rank - 1], ranks[rank - 1], False, race_rows, {})
+        players.add(completed_races[rank - 1][1])
+    for completed_race, race_rank in zip(completed_races, ranks):
+        if completed_race[0] not in race_rows and completed_race[4] != race_rank:
+            race_rows[completed_race[0]] = (completed_race[3], race_rank)
+    _write_points_updates(race_rows, {})
+    invalidate_records(race.map_id)
+    reconcile_player_totals(players)
+    return True
+
+
+def _map_evaluate_points_loop(mid, reset, update_players):
+    """Evaluates points for map 'mid' by saving every race and player separately."""
+
+    # get Race objects with times (sorted by racetime, equal times by id)
+    completed_races = Race.objects.filter(map__id=mid, time__isnull=False).order_by('time', 'id')
     num_completed_races = len(completed_races)
 
     if num_completed_races == 0:
         # no races to award points
-        return
+        return set()
 
-    # get all Race objects (sorted by playtime descendingly)
-    all_races = Race.objects.filter(map__id=mid).order_by('-playtime').select_related('player')
+    # equal racetimes share a rank (for medals)
+    ranks = dense_ranks([race.time for race in completed_races])
 
     # determine points for first place
     best_race = completed_races[0]
-    rec_points = map_get_rec_value(num_completed_races, all_races, best_race)
+    rec_points = map_get_rec_value(mid, best_race.pk)
 
     # update race/player points
-    _update_points(best_race, rec_points, 1, reset)
+    _update_points(best_race, rec_points, ranks[0], reset, update_players)
 
     if num_completed_races == 1:
         # no further races to award points
-        return
+        return set([best_race.player_id])
 
-    top20avg = average([race.time for race in completed_races[:20]])  # average of top 20 racetimes
+    top20avg = average([race.time for race in completed_races[:TOP_AVERAGE_SIZE]])  # average of top 20 racetimes
 
     # cap 2nd place by predefined percentage, with a minimum points difference of 2
     second_place_cap = min(rec_points - 2, rec_points * SECOND_PLACE_PERC)
@@ -131,11 +419,11 @@ def map_evaluate_points(mid, reset):
                               (x * ((completed_races[1].time - first_time) / (top20avg * 0.8))))
 
     # update race/player points
-    _update_points(completed_races[1], second_place_points, 2, reset)
+    _update_points(completed_races[1], second_place_points, ranks[1], reset, update_players)
 
     if num_completed_races == 2:
         # no further races to award points
-        return
+        return set(race.player_id for race in completed_races)
 
     # award points for 3rd, 4th... place by differentiating their times with first place, with a minimum of 2
     # points to the previous time
@@ -143,25 +431,102 @@ def map_evaluate_points(mid, reset):
     for rank, race in enumerate(completed_races[2:]):
         calculated_points = max(0, min(points_above - 2, second_place_cap -
                                        (x * ((race.time - first_time) / (top20avg * 0.8)))))
-        _update_points(race, calculated_points, 3 + rank, reset)
+        _update_points(race, calculated_points, ranks[2 + rank], reset, update_players)
         points_above = calculated_points
+    return set(race.player_id for race in completed_races)
 
 
-def get_record(flt):
-    """
-    Get the maps serialized record race
+def reconcile_player_totals(player_ids=None):
+    """Recomputes Player.points and Player.maps_finished from the evaluated races of the players.
 
-    Args:
-        flt - A kwarg dict to filter race objects by
+    Both columns are derived with a single GROUP BY aggregate over Race, instead of relying on the floating-point
+    deltas of _update_points. Only players whose totals drifted are written.
 
-    Returns:
-        The serialized race dictionary or None if no race exists
+    :param player_ids:  ids of the players to reconcile, None for all players
+    :return: dict with the number of corrected players and the total absolute drift in points and maps_finished
     """
-    try:
-        record = Race.objects.filter(time__isnull=False, **flt).order_by('time')[0]
-        return raceSerializer(record)
-    except:
+    races = Race.objects.filter(time__isnull=False, points__gte=0)
+    players = Player.objects.all()
+    if player_ids is not None:
+        player_ids = list(player_ids)
+        if not player_ids:
+            return {'players': 0, 'points': 0.0, 'maps_finished': 0}
+        races = races.filter(player__in=player_ids)
+        players = players.filter(id__in=player_ids)
+
+    totals = dict((t['player'], (t['total_points'], t['finished'])) for t in
+                  races.values('player').order_by().annotate(total_points=Sum('points'), finished=Count('id')))
+
+    rows = {}
+    drift_points = 0
+    drift_maps = 0
+    for pid, points, maps_finished in players.values_list('id', 'points', 'maps_finished'):
+        total_points, finished = totals.get(pid, (0, 0))
+        if points != total_points or maps_finished != finished:
+            rows[pid] = (total_points, finished)
+            drift_points += abs(points - total_points)
+            drift_maps += abs(maps_finished - finished)
+
+    with transaction.atomic():
+        bulk_update(Player, rows, ('points', 'maps_finished'))
+
+    # points are stored in thousands
+    return {'players': len(rows), 'points': drift_points / 1000.0, 'maps_finished': drift_maps}
+
+
+def snapshot_leaderboards(date=None):
+    """Stores the points leaderboard and the top races of every map for day 'date'.
+
+    Taking the snapshot again on the same day replaces the rows of that day.
+
+    :param date: day of the snapshot, defaults to today
+    :return: (number of player rows, number of map rows) written
+    """
+    if date is None:
+        date = timezone.now().date()
+
+    player_rows = []
+    rank = 0
+    points_above = None
+    players = Player.objects.filter(maps_finished__gt=0).order_by('-points', 'id')\
+        .values_list('id', 'points', 'maps_finished')
+    for position, (pid, points, maps_finished) in enumerate(players.iterator(), 1):
+        if points != points_above:
+            # players with equal points share a rank
+            rank = position
+            points_above = points
+        player_rows.append(PlayerSnapshot(player_id=pid, date=date, points=points, rank=rank,
+                                          maps_finished=maps_finished))
+
+    map_rows = [MapSnapshot(map_id=mid, date=date, rank=race_rank, player_id=pid, time=time, points=points)
+                for mid, race_rank, pid, time, points in
+                Race.objects.filter(time__isnull=False, rank__range=(1, MAP_SNAPSHOT_SIZE))
+                .values_list('map', 'rank', 'player', 'time', 'points')]
+
+    with transaction.atomic():
+        PlayerSnapshot.objects.filter(date=date).delete()
+        MapSnapshot.objects.filter(date=date).delete()
+        PlayerSnapshot.objects.bulk_create(player_rows, batch_size=SNAPSHOT_BATCH_SIZE)
+        MapSnapshot.objects.bulk_create(map_rows, batch_size=SNAPSHOT_BATCH_SIZE)
+    return len(player_rows), len(map_rows)
+
+
+def get_points_gained(player, days=7):
+    """Returns the number of points a player gained in the last 'days' days, based on the daily snapshots.
+
+    :return: None|float
+    """
+    since = timezone.now().date() - datetime.timedelta(days=days)
+    snapshots = PlayerSnapshot.objects.filter(player=player, date__lte=since).order_by('-date')[:1]
+    if not snapshots:
         return None
+    return player.get_points() - snapshots[0].get_points()
+
+
+def get_rank_history(player, days=30):
+    """Returns the daily snapshots of a player's leaderboard position of the last 'days' days, oldest first."""
+    since = timezone.now().date() - datetime.timedelta(days=days)
+    return list(PlayerSnapshot.objects.filter(player=player, date__gte=since).order_by('date'))
 
 
 def is_default_username(username):
@@ -169,32 +534,332 @@ def is_default_username(username):
     return _playerre.match(username)
 
 
-def get_next_computation_date():
+def map_score(mid, reset=False):
+    """Evaluates points for map 'mid' and records which ingestion version of the map they were computed for.
+
+    The version of the map is taken before evaluating and compared-and-swapped afterwards. If races were ingested in
+    the meantime the version has moved, and the map is queued for another evaluation.
+
+    :param mid:     map to evaluate races of
+    :param reset:   see map_evaluate_points
+    :return: (set of ids of the players whose race was (re-)evaluated, True if the map was queued again)
     """
-    Returns the next execution of racesow.tasks.recompute_update_maps according to its interval schedule
+    version = MapVersion.objects.get_or_create(map_id=mid)[0].version
+    players = map_evaluate_points(mid, reset, update_players=False)
+
+    if MapVersion.objects.filter(map_id=mid, version=version).update(scored_version=version):
+        Map.objects.filter(pk=mid).update(last_computation=timezone.now())
+        return players, False
 
-    :return: None|str
+    queue_map(mid)
+    return players, True
+
+
+def bump_map_version(mid):
+    """Increments the ingestion version of map 'mid', to be called whenever races or playtimes are stored."""
+    if not MapVersion.objects.filter(map_id=mid).update(version=F('version') + 1):
+        try:
+            with transaction.atomic():
+                MapVersion.objects.create(map_id=mid, version=1)
+        except IntegrityError:
+            # created concurrently
+            MapVersion.objects.filter(map_id=mid).update(version=F('version') + 1)
+    # the record or oneliner may have changed
+    invalidate_map(mid)
+
+
+def mark_map_dirty(mid):
+    """Bumps the ingestion version of map 'mid' and queues it for computation of points.
+
+    :param mid: id of the map with new race times or playtimes
     """
-    last_task = TaskState.objects.filter(name='racesow.tasks.recompute_updated_maps').order_by('-tstamp')
-    if not last_task:
-        return None
+    bump_map_version(mid)
+    queue_map(mid)
+
+
+def queue_map(mid):
+    """Queues map 'mid' for computation of points, postponing the computation if it is queued already."""
+    now = timezone.now()
+    if DirtyMap.objects.filter(map_id=mid).update(updated=now):
+        return
+
+    try:
+        with transaction.atomic():
+            DirtyMap.objects.create(map_id=mid, queued=now, updated=now)
+    except IntegrityError:
+        # queued concurrently
+        DirtyMap.objects.filter(map_id=mid).update(updated=now)
+
+
+def claim_dirty_maps():
+    """Removes the maps that are due for computation of points from the queue.
+
+    A map is due when it has not been marked dirty for settings.POINTS_DEBOUNCE seconds, or when it has been queued
+    for settings.POINTS_MAX_DELAY seconds (so maps that are played continuously still get their points). Maps whose
+    dispatch or computation fails are queued again by the tasks, see racesow.tasks.recompute_map.
+
+    :return: list of map ids to compute points for
+    """
+    now = timezone.now()
+    due = Q(updated__lte=now - datetime.timedelta(seconds=settings.POINTS_DEBOUNCE)) | \
+        Q(queued__lte=now - datetime.timedelta(seconds=settings.POINTS_MAX_DELAY))
 
-    last_task = last_task[0]
-    base_time = last_task.tstamp
-    soonest = None
+    with transaction.atomic():
+        map_ids = list(DirtyMap.objects.select_for_update().filter(due).values_list('map_id', flat=True))
+        DirtyMap.objects.filter(map_id__in=map_ids).delete()
+    return map_ids
+
+
+def get_next_computation_date(map_):
+    """
+    Returns the date/time at which the points of a map will be computed, see claim_dirty_maps
+
+    :return: None|datetime
+    """
     try:
-        # find all PeriodicTask entries that contain this task
-        for ptask in PeriodicTask.objects.filter(task='racesow.tasks.recompute_updated_maps'):
-            try:
-                int_sched = IntervalSchedule.objects.get(pk=ptask.interval_id)
-                time_delta = datetime.timedelta(**{int_sched.period: int_sched.every})
-                next_run = base_time + time_delta
-
-                # remember the soonest execution
-                if not soonest or next_run < soonest:
-                    soonest = next_run
-            except IntervalSchedule.DoesNotExist:
-                pass
-    except PeriodicTask.DoesNotExist:
-        pass
-    return soonest
+        dirty = DirtyMap.objects.get(map=map_)
+    except DirtyMap.DoesNotExist:
+        return None
+
+    return min(dirty.updated + datetime.timedelta(seconds=settings.POINTS_DEBOUNCE),
+               dirty.queued + datetime.timedelta(seconds=settings.POINTS_MAX_DELAY))
+
+
+def store_race(server, pid, mid, time, checkpoints, clear_oneliner):
+    """Stores a race submitted by a game server as the player's Race of the map and in the race history.
+
+    The caller should update the ranks of the map (map_assign_ranks) and queue the re-evaluation of the points.
+
+    :param server:          Server the race was performed on
+    :param checkpoints:     list of checkpoint times
+    :param clear_oneliner:  True to remove the oneliner of the map
+    :return: (the stored Race, previous time of the race)
+    """
+    if clear_oneliner:
+        # remove old oneliner
+        Map.objects.filter(pk=mid).update(oneliner="")
+
+    # No checks that the race is faster. That should be done on the gameserver
+    race, created = Race.objects.get_or_create(player_id=pid, map_id=mid)
+
+    if created:
+        Player.objects.filter(pk=pid).update(maps=F('maps') + 1)
+
+    # Update race history
+    RaceHistory.objects.create(
+        player_id=pid,
+        map_id=mid,
+        server=server,
+        time=time,
+        playtime=race.playtime,
+        created=race.created,
+        last_played=race.last_played,
+        checkpoints=pack_checkpoints(checkpoints))
+
+    # Update the record race
+    old_time = race.time
+    race.set_points(-1)  # set negative points to indicate that this race is not yet processed
+    race.server = server
+    race.time = time
+    race.created = timezone.now()
+    race.last_played = timezone.now()
+    race.set_checkpoints(checkpoints)
+    # leave the playtime to the counters
+    race.save(update_fields=['points', 'server', 'time', 'created', 'last_played', 'checkpoints'])
+
+    # Delete checkpoint rows from before checkpoints were packed into the race
+    if not created:
+        Checkpoint.objects.filter(race=race).delete()
+
+    if clear_oneliner:
+        # trigger computation of points for this map
+        mark_map_dirty(mid)
+    else:
+        # let running evaluations of this map know that it has a new race
+        bump_map_version(mid)
+
+    race_stored(race)
+    return race, old_time
+
+
+def apply_race_submission(submission_id):
+    """Stores the race of a RaceSubmission, unless it has been stored already.
+
+    :return: (race id, previous time of the race) to re-evaluate the points of, None if it was applied before
+    """
+    with transaction.atomic():
+        # the lock keeps a concurrent delivery of the same submission waiting until this one is done
+        submission = RaceSubmission.objects.select_for_update().get(pk=submission_id)
+        if submission.applied is not None:
+            return None
+
+        race = json.loads(submission.payload)
+        race, old_time = store_race(submission.server, race['pid'], race['mid'], race['time'], race['checkpoints'],
+                                    race['co'] == 1)
+        submission.applied = timezone.now()
+        submission.save(update_fields=['applied'])
+    return race.id, old_time
+
+
+def get_pending_race_submissions(seconds=RACE_SUBMISSION_RETRY_DELAY):
+    """Lists the race submissions that were received more than 'seconds' seconds ago and are still not applied, e.g.
+    because queueing them failed or their task was lost.
+
+    :return: list of submission ids, oldest first
+    """
+    created = timezone.now() - datetime.timedelta(seconds=seconds)
+    return list(RaceSubmission.objects.filter(applied__isnull=True, created__lt=created)
+                .order_by('created').values_list('id', flat=True))
+
+
+def purge_race_submissions(days=RACE_SUBMISSION_RETENTION):
+    """Deletes the race submissions that were applied more than 'days' days ago.
+
+    :return: number of deleted submissions
+    """
+    submissions = RaceSubmission.objects.filter(applied__lt=timezone.now() - datetime.timedelta(days=days))
+    count = submissions.count()
+    submissions.delete()
+    return count
+
+
+def store_races(server, entries):
+    """Stores a batch of races submitted by a game server in a single transaction.
+
+    Does the same as APIRace.post for every entry, but with bulk statements for the races and the race history.
+    Entries for the same player and map are applied in order, the last one ends up in Race.
+
+    :param server:  Server the races were performed on
+    :param entries: list of dicts with keys 'pid', 'mid', 'time', 'checkpoints' and optionally 'co' (1 to clear the
+                    oneliner of the map)
+    :return: (list with the serialized race or an error dict for every entry,
+              list of (race id, previous time) tuples of the races whose points should be re-evaluated)
+    """
+    results = [None] * len(entries)
+    valid = []
+    for i, entry in enumerate(entries):
+        try:
+            valid.append((i, int(entry['pid']), int(entry['mid']), int(entry['time']),
+                          [int(t) for t in entry['checkpoints']], int(entry.get('co', 0)) == 1))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            results[i] = {'error': 'Missing parameters for race'}
+
+    players = Player.objects.in_bulk(set(entry[1] for entry in valid))
+    maps = Map.objects.in_bulk(set(entry[2] for entry in valid))
+    for entry in list(valid):
+        if entry[1] not in players or entry[2] not in maps:
+            results[entry[0]] = {'error': 'Could not find player {} or map {}'.format(entry[1], entry[2])}
+            valid.remove(entry)
+    if not valid:
+        return results, []
+
+    keys = set((entry[1], entry[2]) for entry in valid)
+    now = timezone.now()
+
+    def get_races():
+        races = Race.objects.filter(player__in=set(pid for pid, mid in keys), map__in=set(mid for pid, mid in keys))
+        return dict(((race.player_id, race.map_id), race) for race in races if (race.player_id, race.map_id) in keys)
+
+    with transaction.atomic():
+        races = get_races()
+        missing = keys - set(races)
+        if missing:
+            Race.objects.bulk_create([Race(player_id=pid, map_id=mid) for pid, mid in missing])
+            new_maps = {}
+            for pid, mid in missing:
+                new_maps[pid] = (new_maps.get(pid, (0,))[0] + 1,)
+            bulk_update(Player, new_maps, ('maps',), increment=True)
+            races = get_races()
+        old_times = [(race.id, race.time) for race in races.values()]
+
+        history = []
+        checkpoints = {}
+        for i, pid, mid, time, race_checkpoints, clear_oneliner in valid:
+            race = races[(pid, mid)]
+            history.append(RaceHistory(player_id=pid, map_id=mid, server=server, time=time, playtime=race.playtime,
+                                       created=race.created, last_played=race.last_played,
+                                       checkpoints=pack_checkpoints(race_checkpoints)))
+            race.time = time
+            race.created = now
+            race.last_played = now
+            checkpoints[race.id] = race_checkpoints
+
+        RaceHistory.objects.bulk_create(history, batch_size=RACE_BATCH_INSERT_SIZE)
+
+        # set negative points to indicate that the races are not yet processed
+        race_ids = list(checkpoints)
+        Race.objects.filter(pk__in=race_ids).update(points=-1000, server=server, created=now, last_played=now)
+        packed = Race._meta.get_field('checkpoints')
+        bulk_update(Race, dict((race.id, (race.time, packed.get_db_prep_value(pack_checkpoints(checkpoints[race.id]),
+                                                                              connection)))
+                               for race in races.values()), ('time', 'checkpoints'))
+
+        # checkpoint rows from before checkpoints were packed into the race
+        Checkpoint.objects.filter(race__in=race_ids).delete()
+
+        cleared = set(entry[2] for entry in valid if entry[5])
+        if cleared:
+            Map.objects.filter(pk__in=cleared).update(oneliner='')
+
+    for mid in set(entry[2] for entry in valid):
+        if mid in cleared:
+            # trigger computation of points for this map
+            mark_map_dirty(mid)
+        else:
+            # let running evaluations of this map know that it has new races
+            bump_map_version(mid)
+
+    stored = Race.objects.in_bulk(race_ids)
+    for race in stored.values():
+        race_stored(race)
+    for i, pid, mid, time, race_checkpoints, clear_oneliner in valid:
+        results[i] = raceSerializer(stored[races[(pid, mid)].id])
+    return results, old_times
+
+
+def store_session(mid, entries):
+    """Stores the playtimes and race counts of all players that played a map session, in a single transaction.
+
+    Does the same as APIPlayer.post for every entry, with set-based increments for the players and races, a bulk
+    insert for the race history and a single computation request for the map. Entries of the same player are summed.
+
+    :param mid:     map that was played
+    :param entries: list of dicts with keys 'username', 'playTime' and 'races'
+    :return: list of the usernames that could not be found
+    """
+    increments = {}
+    for entry in entries:
+        username = entry['username']
+        playtime, races = increments.get(username, (0, 0))
+        increments[username] = (playtime + int(entry['playTime']), races + int(entry['races']))
+
+    players = dict(Player.objects.filter(username__in=list(increments)).values_list('id', 'username'))
+    unknown = sorted(set(increments) - set(players.values()))
+    if not players:
+        return unknown
+
+    now = timezone.now()
+    with transaction.atomic():
+        existing = set(Race.objects.filter(map_id=mid, player__in=list(players)).values_list('player', flat=True))
+        created = set(players) - existing
+        if created:
+            Race.objects.bulk_create([Race(player_id=pid, map_id=mid) for pid in created])
+
+        bulk_update(Player, dict((pid, increments[username] + (1 if pid in created else 0,))
+                                 for pid, username in players.items()), ('playtime', 'races', 'maps'), increment=True)
+
+        races = list(Race.objects.filter(map_id=mid, player__in=list(players)))
+        bulk_update(Race, dict((race.id, (increments[players[race.player_id]][0],)) for race in races), ('playtime',),
+                    increment=True)
+        # set negative points to indicate that the races are not yet processed
+        Race.objects.filter(pk__in=[race.id for race in races]).update(last_played=now, points=-1000)
+
+        RaceHistory.objects.bulk_create([
+            RaceHistory(player_id=race.player_id, map_id=mid, server_id=race.server_id, time=race.time,
+                        playtime=race.playtime + increments[players[race.player_id]][0], created=race.created,
+                        last_played=now)
+            for race in races], batch_size=RACE_BATCH_INSERT_SIZE)
+
+    # trigger computation of points for this map
+    mark_map_dirty(mid)
+    return unknown
@@ -1,12 +1,10 @@
 from __future__ import absolute_import
 
-import time
-import datetime
-
-from celery import shared_task
+from celery import chord, shared_task
 from celery.utils.log import get_task_logger
+from django.conf import settings
 
-from .models import Map, Player, Race
+from .models import Map, Race
 from racesow import services
 
 
@@ -14,66 +12,117 @@ logger = get_task_logger(__name__)
 
 
 @shared_task
-def force_recompute_all():
+def force_recompute_all(shards=None):
     logger.info("force_recompute_all starting")
 
-    # reset all player point/maps_finished totals
-    for player in Player.objects.all():
-        player.maps_finished = 0
-        player.points = 0
-        player.save()
+    # re-evaluate points for all maps, split in shards that are processed by the available workers
+    if shards is None:
+        shards = settings.RECOMPUTE_SHARDS
+    map_ids = list(Map.objects.values_list('id', flat=True))
+    header = [recompute_map_shard.s(map_ids[i::shards]) for i in range(shards) if map_ids[i::shards]]
+
+    chord(header)(finish_recompute_all.s())
+
 
-    # re-evaluate points for all maps
-    for map_ in Map.objects.all():
+@shared_task
+def recompute_map_shard(map_ids):
+    requeued = 0
+    for mid in map_ids:
         # awards points to finished races on this map.
-        services.map_evaluate_points(map_.id, reset=True)
-        # reset=True indicates that all Player.points/Player.maps_finished columns have been set to 0 and that the
-        # current Race.points values should be discarded. The method recomputes Race.points for all players, adds this
-        # to Player.points and increments Player.finished_maps
+        players, queued = services.map_score(mid, reset=True)
+        # reset=True indicates that the current Race.points values should be discarded. The method recomputes
+        # Race.points for all players, the player totals are reconciled with these in finish_recompute_all.
+        # Maps that received races while being evaluated are queued for the normal task again
+        requeued += queued
+    return requeued
 
-        map_.compute_points = False
-        map_.last_computation = datetime.datetime.now()
-        map_.save()
 
-    # Check for races made during this task.
-    # This is necessary to prevent races from staying at -1 points for possibly long periods of time
-    while True:
-        new_races = Race.objects.filter(time__isnull=False, points=-1000)
-        new_races.query.group_by = ['map_id']
+@shared_task
+def finish_recompute_all(requeued_per_shard):
+    # sum up Race.points and finished races for every player in one go
+    drift = services.reconcile_player_totals()
+    logger.info("totals of {players} players corrected by {points} points and {maps_finished} finished "
+                "maps".format(**drift))
+    logger.info("force_recompute_all done, {} maps updated during task".format(sum(requeued_per_shard)))
+
+    # the leaderboard of today changed completely, replace its snapshot
+    snapshot_leaderboards()
+
+
+@shared_task
+def recompute_race(race_id, old_time):
+    # re-scores the part of the map ranking affected by a new time of this race (or the whole map if needed)
+    try:
+        return services.map_evaluate_race(race_id, old_time)
+    except Exception:
+        # queue the whole map instead, otherwise the race keeps its unevaluated points
+        for mid in Race.objects.filter(pk=race_id).values_list('map', flat=True):
+            services.queue_map(mid)
+        raise
 
-        if not new_races:
-            logger.info("force_recompute_all done")
-            return
-        # else: new races were registered during this task and map_.compute_points was overwritten
 
-        logger.info("{} maps updated during task".format(len(new_races)))
+@shared_task
+def apply_race_submission(submission_id):
+    # stores a race that was posted asynchronously, retried deliveries of a submission are ignored
+    applied = services.apply_race_submission(submission_id)
+    if applied is not None:
+        # re-score the affected part of the map ranking
+        recompute_race.delay(*applied)
 
-        for race in new_races:
-            # set recompute bit for each map..
-            race.map.compute_points = True
 
-        # update these maps using the normal task
-        recompute_updated_maps()
+# scheduled to run every minute
+@shared_task
+def retry_race_submissions():
+    # queue the submissions again whose first delivery did not get through, applying them twice is a no-op
+    submission_ids = services.get_pending_race_submissions()
+    for submission_id in submission_ids:
+        apply_race_submission.delay(submission_id)
+    if submission_ids:
+        logger.info("queued {} pending race submissions again".format(len(submission_ids)))
+    return len(submission_ids)
 
 
-# scheduled to run every 5 minutes
+# scheduled to run every few seconds
 @shared_task
 def recompute_updated_maps():
-    maps_updated = 0
-    for map_ in Map.objects.filter(compute_points=True):
-        services.map_evaluate_points(map_.id, reset=False)
-        # Recomputes Race points for this map and update Player totals.
-        # For every player that didn't have points yet for their race:
-        # race.points = computed_points
-        #       player.points += Race.points
-        #       player.finished_maps += 1
-        # else if the player's recomputed points are different from the current value (by a 0.01 margin)
-        #       old_points = race.points
-        #       player.points += (computed_points - old_points)
-        #       race.points = computed_points
-
-        map_.compute_points = False
-        map_.last_computation = datetime.datetime.now()
-        map_.save()
-        maps_updated += 1
-    return maps_updated
\ No newline at end of file
+    # dispatch the maps that have been quiet for a while, see services.claim_dirty_maps
+    map_ids = services.claim_dirty_maps()
+    for i, mid in enumerate(map_ids):
+        try:
+            recompute_map.delay(mid)
+        except Exception:
+            # the claimed maps are no longer queued, put back the ones that were not dispatched
+            for undispatched in map_ids[i:]:
+                services.queue_map(undispatched)
+            raise
+    return len(map_ids)
+
+
+@shared_task
+def recompute_map(mid):
+    # Recomputes Race points for this map, Player totals of the re-evaluated races are reconciled afterwards
+    try:
+        players, requeued = services.map_score(mid)
+    except Exception:
+        # the map was removed from the queue when it was dispatched, queue it again for the next attempt
+        services.queue_map(mid)
+        raise
+
+    # recompute Player.points and Player.maps_finished from the races in bulk
+    drift = services.reconcile_player_totals(players)
+    if drift['players']:
+        logger.info("totals of {players} players corrected by {points} points and {maps_finished} finished "
+                    "maps".format(**drift))
+
+
+# scheduled to run daily
+@shared_task
+def snapshot_leaderboards():
+    players, races = services.snapshot_leaderboards()
+    logger.info("leaderboard snapshot taken of {} players and {} map records".format(players, races))
+
+
+# scheduled to run daily
+@shared_task
+def purge_race_submissions():
+    logger.info("purged {} applied race submissions".format(services.purge_race_submissions()))
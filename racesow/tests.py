@@ -4,16 +4,40 @@ simple testcases, should be expanded for testing services.py
 Usage (debian) from the /website directory:
     python manage.py test racesow
 """
+import base64
+import datetime
+import hashlib
+import json
+import re
 import sys
 import traceback
 
-from django.test import TestCase
+from django.db import DatabaseError, transaction
+from django.core.cache import get_cache
+from django.core.exceptions import PermissionDenied
+from django.test import RequestFactory, TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from mgxrace.handlers import APIHandler
 
 from .models import (
+    Checkpoint,
+    DirtyMap,
     Map,
+    MapSnapshot,
+    MapVersion,
     Player,
-    Race)
-from racesow.utils import millis_to_str, username_with_html_colors
+    PlayerSnapshot,
+    Race,
+    RaceHistory,
+    RaceSubmission,
+    Server,
+    Tag)
+from racesow import cache, counters, mapindex, middleware, services, tasks
+from racesow.utils import millis_to_str, pack_checkpoints, unpack_checkpoints, username_with_html_colors
+from racesow.views import api
+from racesow.views.site import get_rank_chart
 
 
 class MapMethodTests(TestCase):
@@ -103,6 +127,12 @@ class UtilsTests(TestCase):
         millis = 624172
         self.assertEqual(millis_to_str(millis), str_)
 
+    def test_pack_checkpoints(self):
+        times = [0, 1243, 3428945, 2 ** 31 - 1]
+        self.assertEqual(len(pack_checkpoints(times)), 16)
+        self.assertEqual(unpack_checkpoints(pack_checkpoints(times)), times)
+        self.assertEqual(unpack_checkpoints(pack_checkpoints([])), [])
+
 
 class NicknameTests(TestCase):
     def setUp(self):
@@ -189,4 +219,557 @@ class RaceTests(TestCase):
         self.assertEqual(len(Race.objects.filter(time__isnull=False)), 2)
         races = Race.objects.filter(map_id=m.id)
         completed_races = len([race for race in races if race.time is not None])
-        self.assertEqual(completed_races, 2)
\ No newline at end of file
+        self.assertEqual(completed_races, 2)
+
+
+class SharedCacheMixin(object):
+    """Runs the tests with a local memory cache in racesow.cache, the settings only enable it with memcached"""
+
+    def setUp(self):
+        self.settings_cache = cache.cache
+        cache.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        cache.cache.clear()
+
+    def tearDown(self):
+        cache.cache = self.settings_cache
+
+
+class PointsStateMixin(object):
+    """Helpers for the tests of the points engine on the races of self.map_"""
+
+    def _state(self):
+        races = list(Race.objects.filter(map=self.map_).order_by('id').values_list('points', 'rank'))
+        players = list(Player.objects.order_by('id').values_list('points', 'maps_finished'))
+        return races, players
+
+    def _reset(self):
+        Race.objects.filter(map=self.map_).update(points=-1000, rank=0)
+        Player.objects.update(points=0, maps_finished=0)
+
+
+class PointsEngineTests(PointsStateMixin, TestCase):
+
+    def setUp(self):
+        self.map_ = Map.objects.create(name='enginetest')
+        times = [30000, 30500, 31234, 33000, 35000, None, 41000, 52000]
+        playtimes = [4000000, 2000000, 700000, 100, 1900000, 3700000, 0, 650000]
+        for i, (time, playtime) in enumerate(zip(times, playtimes)):
+            player = Player.objects.create(username='engine{}'.format(i), simplified='engine{}'.format(i))
+            Race.objects.create(player=player, map=self.map_, time=time, playtime=playtime, points=-1000)
+
+    def test_engines_equal_on_reset(self):
+        services.map_evaluate_points(self.map_.id, reset=True, engine=services.ENGINE_LOOP)
+        expected = self._state()
+        self._reset()
+        services.map_evaluate_points(self.map_.id, reset=True, engine=services.ENGINE_BULK)
+        self.assertEqual(self._state(), expected)
+
+    def test_engines_equal_in_place(self):
+        for engine in (services.ENGINE_LOOP, services.ENGINE_BULK):
+            self._reset()
+            services.map_evaluate_points(self.map_.id, reset=False, engine=engine)
+            race = Race.objects.get(map=self.map_, time=35000)
+            race.time = 30100
+            race.set_points(-1)
+            race.save()
+            services.map_evaluate_points(self.map_.id, reset=False, engine=engine)
+            if engine == services.ENGINE_LOOP:
+                expected = self._state()
+            Race.objects.filter(pk=race.pk).update(time=35000)
+        self.assertEqual(self._state(), expected)
+
+    def test_reconcile_player_totals(self):
+        services.map_evaluate_points(self.map_.id, reset=True, engine=services.ENGINE_LOOP)
+        expected = self._state()
+        self._reset()
+        players = services.map_evaluate_points(self.map_.id, reset=True, update_players=False)
+        self.assertEqual(len(players), 7)
+        self.assertEqual(Player.objects.filter(points__gt=0).count(), 0)
+
+        drift = services.reconcile_player_totals()
+        self.assertEqual(drift['players'], 7)
+        self.assertEqual(drift['maps_finished'], 7)
+        self.assertEqual(self._state(), expected)
+        self.assertEqual(services.reconcile_player_totals(players)['players'], 0)
+
+    def test_bulk_update_many_rows(self):
+        # more rows than BULK_UPDATE_BATCH_SIZE, with two fields a single batch would exceed SQLite's parameter limit
+        Player.objects.bulk_create([Player(username='bulk{}'.format(i), simplified='bulk{}'.format(i))
+                                    for i in range(services.BULK_UPDATE_BATCH_SIZE + 100)])
+        players = Player.objects.filter(username__startswith='bulk')
+        rows = dict((pk, (pk % 1000, 1)) for pk in players.values_list('id', flat=True))
+        self.assertTrue(services.bulk_update(Player, rows, ('points', 'maps_finished')) >= 2)
+        self.assertEqual(dict((pk, (points, maps)) for pk, points, maps in
+                              players.values_list('id', 'points', 'maps_finished')), rows)
+
+    def test_map_get_rec_value(self):
+        best_race = Race.objects.get(map=self.map_, time=30000)
+        buckets = services.map_count_playtime_buckets(self.map_.id, best_race.id)
+        self.assertEqual(buckets, {services.BUMPTIME_HIGH: 1, services.BUMPTIME_MEDIUM: 2, services.BUMPTIME_LOW: 2})
+        self.assertEqual(services.map_get_rec_value(self.map_.id, best_race.id), 26)
+
+    def test_compute_map_points(self):
+        self.assertEqual(services.compute_map_points([], 10), [])
+        self.assertEqual(services.compute_map_points([1000], 10), [10])
+        points = services.compute_map_points([1000, 1100, 1200, 5000], 20)
+        self.assertEqual(points[0], 20)
+        self.assertTrue(all(a - b >= 2 for a, b in zip(points[1:], points[2:]) if b > 0))
+
+    def test_map_assign_ranks(self):
+        Race.objects.filter(map=self.map_, time=33000).update(time=31234)
+        services.map_assign_ranks(self.map_.id)
+        ranks = list(Race.objects.filter(map=self.map_).order_by('id').values_list('rank', flat=True))
+        self.assertEqual(ranks, [1, 2, 3, 3, 4, 0, 5, 6])
+        self.assertEqual(services.dense_ranks([30000, 30500, 31234, 31234, 35000, 41000, 52000]),
+                         [1, 2, 3, 3, 4, 5, 6])
+
+        services.map_evaluate_points(self.map_.id, reset=False)
+        self.assertEqual(list(Race.objects.filter(map=self.map_).order_by('id').values_list('rank', flat=True)), ranks)
+
+
+class RaceWindowTests(PointsStateMixin, TestCase):
+
+    def setUp(self):
+        self.map_ = Map.objects.create(name='windowtest')
+        for i in range(30):
+            player = Player.objects.create(username='window{}'.format(i), simplified='window{}'.format(i))
+            Race.objects.create(player=player, map=self.map_, time=20000 + 150 * i, playtime=700000 * (i % 7),
+                                points=-1000)
+        services.map_evaluate_points(self.map_.id, reset=False)
+        services.reconcile_player_totals()
+
+    def _improve(self, old_time, new_time):
+        race = Race.objects.get(map=self.map_, time=old_time)
+        Race.objects.filter(pk=race.pk).update(time=new_time, points=-1000)
+        return race.pk
+
+    def test_window_matches_full_evaluation(self):
+        race_id = self._improve(20000 + 150 * 27, 20000 + 150 * 22 + 1)
+        sid = transaction.savepoint()
+        services.map_evaluate_points(self.map_.id, reset=False)
+        services.reconcile_player_totals()
+        expected = self._state()
+        transaction.savepoint_rollback(sid)
+
+        self.assertTrue(services.map_evaluate_race(race_id, 20000 + 150 * 27))
+        self.assertEqual(self._state(), expected)
+
+    def test_window_updates_ranks_of_tied_times(self):
+        # the tie shifts the ranks of all races below it, also where the points stay the same
+        race_id = self._improve(20000 + 150 * 27, 20000 + 150 * 22)
+        sid = transaction.savepoint()
+        services.map_evaluate_points(self.map_.id, reset=False)
+        services.reconcile_player_totals()
+        expected = self._state()
+        transaction.savepoint_rollback(sid)
+
+        self.assertTrue(services.map_evaluate_race(race_id, 20000 + 150 * 27))
+        self.assertEqual(self._state(), expected)
+
+    def test_top_average_change_falls_back(self):
+        race_id = self._improve(20000 + 150 * 25, 20000 + 150 * 3 + 1)
+        self.assertFalse(services.map_evaluate_race(race_id, 20000 + 150 * 25))
+        self.assertEqual(Race.objects.get(pk=race_id).rank, 5)
+
+
+class DirtyMapQueueTests(TestCase):
+
+    def setUp(self):
+        self.map_ = Map.objects.create(name='queuetest')
+
+    def test_mark_map_dirty_deduplicates(self):
+        services.mark_map_dirty(self.map_.id)
+        services.mark_map_dirty(self.map_.id)
+        self.assertEqual(DirtyMap.objects.filter(map=self.map_).count(), 1)
+        self.assertIsNotNone(services.get_next_computation_date(self.map_))
+
+    @override_settings(POINTS_DEBOUNCE=60, POINTS_MAX_DELAY=300)
+    def test_claim_waits_for_quiet_map(self):
+        services.mark_map_dirty(self.map_.id)
+        self.assertEqual(services.claim_dirty_maps(), [])
+        self.assertTrue(DirtyMap.objects.filter(map=self.map_).exists())
+
+    def test_map_score_records_version(self):
+        services.mark_map_dirty(self.map_.id)
+        players, requeued = services.map_score(self.map_.id)
+        self.assertFalse(requeued)
+        version = MapVersion.objects.get(map=self.map_)
+        self.assertEqual((version.version, version.scored_version), (1, 1))
+
+    def test_map_score_requeues_on_ingestion(self):
+        evaluate = services.map_evaluate_points
+
+        def evaluate_during_ingestion(mid, *args, **kwargs):
+            services.bump_map_version(mid)
+            return evaluate(mid, *args, **kwargs)
+
+        services.map_evaluate_points = evaluate_during_ingestion
+        try:
+            players, requeued = services.map_score(self.map_.id)
+        finally:
+            services.map_evaluate_points = evaluate
+        self.assertTrue(requeued)
+        self.assertTrue(DirtyMap.objects.filter(map=self.map_).exists())
+        self.assertEqual(MapVersion.objects.get(map=self.map_).scored_version, 0)
+
+    @override_settings(POINTS_DEBOUNCE=0, POINTS_MAX_DELAY=300)
+    def test_claim_removes_quiet_map(self):
+        services.mark_map_dirty(self.map_.id)
+        self.assertEqual(services.claim_dirty_maps(), [self.map_.id])
+        self.assertFalse(DirtyMap.objects.filter(map=self.map_).exists())
+        self.assertIsNone(services.get_next_computation_date(self.map_))
+
+    @override_settings(POINTS_DEBOUNCE=0, POINTS_MAX_DELAY=300)
+    def test_failed_computation_requeues_map(self):
+        def fail(mid, *args, **kwargs):
+            raise DatabaseError('lost connection')
+
+        services.mark_map_dirty(self.map_.id)
+        self.assertEqual(services.claim_dirty_maps(), [self.map_.id])
+        map_score, services.map_score = services.map_score, fail
+        try:
+            self.assertRaises(DatabaseError, tasks.recompute_map, self.map_.id)
+        finally:
+            services.map_score = map_score
+        self.assertTrue(DirtyMap.objects.filter(map=self.map_).exists())
+
+    def test_failed_race_evaluation_queues_map(self):
+        def fail(race_id, old_time):
+            raise DatabaseError('lost connection')
+
+        race = Race.objects.create(player=Player.objects.create(username='racer', simplified='racer'), map=self.map_,
+                                   time=1000)
+        map_evaluate_race, services.map_evaluate_race = services.map_evaluate_race, fail
+        try:
+            self.assertRaises(DatabaseError, tasks.recompute_race, race.id, None)
+        finally:
+            services.map_evaluate_race = map_evaluate_race
+        self.assertTrue(DirtyMap.objects.filter(map=self.map_).exists())
+
+
+class SnapshotTests(TestCase):
+
+    def test_snapshot_ranks_and_replaces_day(self):
+        for i, points in enumerate([5000, 8000, 5000, 0]):
+            Player.objects.create(username='snap{}'.format(i), name='snap{}'.format(i),
+                                  simplified='snap{}'.format(i), points=points, maps_finished=1 if points else 0)
+        self.assertEqual(services.snapshot_leaderboards(), (3, 0))
+        self.assertEqual(services.snapshot_leaderboards(), (3, 0))
+        ranks = PlayerSnapshot.objects.order_by('player__username').values_list('player__username', 'rank')
+        self.assertEqual(list(ranks), [('snap0', 2), ('snap1', 1), ('snap2', 2)])
+
+    def test_rank_chart(self):
+        snapshots = [PlayerSnapshot(rank=rank) for rank in (3, 1, 2)]
+        chart = get_rank_chart(snapshots)
+        self.assertEqual((chart['best'], chart['worst']), (1, 3))
+        self.assertEqual(chart['points'], '0.0,75.0 225.0,5.0 450.0,40.0')
+
+    def test_snapshot_of_tied_races(self):
+        map_ = Map.objects.create(name='snaptest')
+        for i, time in enumerate([10000, 10000, 12000]):
+            player = Player.objects.create(username='snap{}'.format(i), simplified='snap{}'.format(i))
+            Race.objects.create(player=player, map=map_, time=time)
+        services.map_assign_ranks(map_.id)
+        self.assertEqual(services.snapshot_leaderboards(), (0, 3))
+        ranks = MapSnapshot.objects.order_by('player__username').values_list('rank', flat=True)
+        self.assertEqual(list(ranks), [1, 1, 2])
+
+
+class RaceBatchTests(TestCase):
+
+    def setUp(self):
+        self.server = Server.objects.create(auth_key='key', address='127.0.0.1', name='batch', simplified='batch')
+        self.map_ = Map.objects.create(name='batchtest')
+        self.players = [Player.objects.create(username='batch{}'.format(i), simplified='batch{}'.format(i))
+                        for i in range(2)]
+        Race.objects.create(player=self.players[0], map=self.map_, time=40000)
+
+    def test_store_races(self):
+        entries = [
+            {'pid': self.players[0].id, 'mid': self.map_.id, 'time': 35000, 'checkpoints': [1000, 2000]},
+            {'pid': self.players[1].id, 'mid': self.map_.id, 'time': 30000, 'checkpoints': [900]},
+            {'pid': self.players[1].id, 'mid': self.map_.id + 1, 'time': 30000, 'checkpoints': []},
+            {'pid': self.players[1].id, 'mid': self.map_.id},
+        ]
+        results, old_times = services.store_races(self.server, entries)
+
+        self.assertEqual([r['time'] for r in results[:2]], [35000, 30000])
+        self.assertEqual([len(r['checkpoints']) for r in results[:2]], [2, 1])
+        self.assertIn('error', results[2])
+        self.assertIn('error', results[3])
+        self.assertEqual(sorted(time for race_id, time in old_times), [None, 40000])
+
+        self.assertEqual(RaceHistory.objects.filter(server=self.server).count(), 2)
+        self.assertEqual(Checkpoint.objects.count(), 0)
+        self.assertEqual(Race.objects.get(player=self.players[0], map=self.map_).get_checkpoints(), [1000, 2000])
+        self.assertEqual(Player.objects.get(pk=self.players[1].id).maps, 1)
+        races = Race.objects.filter(map=self.map_).order_by('time')
+        self.assertEqual([(r.player_id, r.points) for r in races],
+                         [(self.players[1].id, -1000), (self.players[0].id, -1000)])
+
+    def test_unreachable_broker_marks_map_dirty(self):
+        class Unreachable(object):
+            def delay(self, *args):
+                raise IOError('broker is down')
+
+        recompute_race, api.recompute_race = api.recompute_race, Unreachable()
+        try:
+            api.queue_recompute_race(1, None, self.map_.id)
+        finally:
+            api.recompute_race = recompute_race
+        self.assertTrue(DirtyMap.objects.filter(map=self.map_).exists())
+
+    def test_race_submission_is_applied_once(self):
+        submission = RaceSubmission.objects.create(server=self.server, key='abc', payload=json.dumps(
+            {'pid': self.players[1].id, 'mid': self.map_.id, 'time': 30000, 'checkpoints': [900], 'co': 0}))
+        race_id, old_time = services.apply_race_submission(submission.id)
+        self.assertIsNone(old_time)
+        self.assertIsNone(services.apply_race_submission(submission.id))
+
+        self.assertEqual(RaceHistory.objects.filter(server=self.server).count(), 1)
+        race = Race.objects.get(pk=race_id)
+        self.assertEqual((race.time, race.get_checkpoints()), (30000, [900]))
+        self.assertIsNotNone(RaceSubmission.objects.get(pk=submission.id).applied)
+
+    def test_pending_race_submissions(self):
+        payload = json.dumps({'pid': self.players[1].id, 'mid': self.map_.id, 'time': 30000, 'checkpoints': [],
+                              'co': 0})
+        old = timezone.now() - datetime.timedelta(seconds=services.RACE_SUBMISSION_RETRY_DELAY + 1)
+        pending = RaceSubmission.objects.create(server=self.server, key='old', payload=payload, created=old)
+        RaceSubmission.objects.create(server=self.server, key='new', payload=payload)
+        RaceSubmission.objects.create(server=self.server, key='done', payload=payload, created=old, applied=old)
+        self.assertEqual(services.get_pending_race_submissions(), [pending.id])
+
+    def test_store_session(self):
+        entries = [
+            {'username': 'batch0', 'playTime': 1000, 'races': 2},
+            {'username': 'batch1', 'playTime': 500, 'races': 1},
+            {'username': 'batch1', 'playTime': 250, 'races': 1},
+            {'username': 'unknown', 'playTime': 250, 'races': 1},
+        ]
+        self.assertEqual(services.store_session(self.map_.id, entries), ['unknown'])
+
+        players = Player.objects.filter(username__startswith='batch').order_by('username')
+        self.assertEqual([(p.playtime, p.races, p.maps) for p in players], [(1000, 2, 0), (750, 2, 1)])
+        races = Race.objects.filter(map=self.map_).order_by('player__username')
+        self.assertEqual([(r.playtime, r.points) for r in races], [(1000, -1000), (750, -1000)])
+        self.assertEqual(RaceHistory.objects.filter(map=self.map_).count(), 2)
+        self.assertTrue(DirtyMap.objects.filter(map=self.map_).exists())
+
+
+class CounterTests(TestCase):
+
+    def setUp(self):
+        self.map_ = Map.objects.create(name='countertest')
+        self.start_flusher = counters._start_flusher
+        counters._start_flusher = lambda interval: None
+
+    def tearDown(self):
+        counters._start_flusher = self.start_flusher
+
+    @override_settings(COUNTER_FLUSH_INTERVAL=5)
+    def test_increments_are_buffered(self):
+        counters.increment(Map, self.map_.id, races=2, playtime=1000)
+        counters.increment(Map, self.map_.id, races=1)
+        self.assertEqual(counters.stats()['rows'], 1)
+        self.assertEqual(counters.pending(Map, self.map_.id, 'races'), 3)
+        self.assertEqual(Map.objects.get(pk=self.map_.id).races, 0)
+
+        self.assertEqual(counters.flush(), 1)
+        map_ = Map.objects.get(pk=self.map_.id)
+        self.assertEqual((map_.races, map_.playtime), (3, 1000))
+        self.assertEqual(counters.stats()['rows'], 0)
+
+    @override_settings(COUNTER_FLUSH_INTERVAL=0)
+    def test_write_through(self):
+        counters.increment(Map, self.map_.id, races=1)
+        self.assertEqual(Map.objects.get(pk=self.map_.id).races, 1)
+
+
+class ServerAuthenticationTests(SharedCacheMixin, TestCase):
+
+    def setUp(self):
+        super(ServerAuthenticationTests, self).setUp()
+        self.server = Server.objects.create(auth_key='key', address='127.0.0.1', name='auth', simplified='auth')
+        self.middleware = middleware.ServerAuthenticationMiddleware()
+        # servers of other tests may have had the same id
+        middleware._servers.clear()
+        middleware._verified.clear()
+
+    def _request(self, key='key'):
+        token = base64.b64encode(hashlib.sha256('1234|{}'.format(key)).digest(), '-_')
+        return RequestFactory().get('/api/map/', {'uTime': '1234', 'sToken': '{}.{}'.format(self.server.id, token)})
+
+    def test_cached_authentication(self):
+        request = self._request()
+        self.middleware.process_request(request)
+        self.assertEqual(request.server.id, self.server.id)
+
+        request = self._request()
+        with self.assertNumQueries(0):
+            self.middleware.process_request(request)
+        self.assertEqual(request.server.id, self.server.id)
+
+    def test_edited_server_is_reloaded(self):
+        self.middleware.process_request(self._request())
+        self.server.auth_key = 'newkey'
+        self.server.save()
+
+        self.assertRaises(PermissionDenied, self.middleware.process_request, self._request())
+        self.middleware.process_request(self._request('newkey'))
+
+    def test_server_edited_by_other_process_is_reloaded(self):
+        self.middleware.process_request(self._request())
+        # another process saved the server, only the shared generation tells this one
+        Server.objects.filter(pk=self.server.id).update(auth_key='newkey')
+        cache.invalidate_server(self.server.id)
+
+        self.assertRaises(PermissionDenied, self.middleware.process_request, self._request())
+        self.middleware.process_request(self._request('newkey'))
+
+
+class APIHandlerTests(TestCase):
+
+    def test_api_runs_server_authentication_only(self):
+        handler = APIHandler()
+        handler.load_middleware()
+        self.assertEqual(len(handler._request_middleware), 1)
+
+        # no session is loaded for the request
+        with self.assertNumQueries(0):
+            response = handler.get_response(RequestFactory().get('/api/map/'))
+        self.assertEqual(response.status_code, 403)
+
+
+class MapCacheTests(SharedCacheMixin, TestCase):
+
+    def setUp(self):
+        super(MapCacheTests, self).setUp()
+        # ids are reused between tests and the generation may be the same after clearing the cache
+        mapindex._index = None
+        self.map_ = Map.objects.create(name='cachetest')
+        self.player = Player.objects.create(username='cache', simplified='cache')
+
+    def tearDown(self):
+        super(MapCacheTests, self).tearDown()
+        mapindex._index = None
+
+    def test_map_id(self):
+        self.assertEqual(cache.get_map_id('cachetest'), self.map_.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get_map_id('cachetest'), self.map_.id)
+        self.assertIsNone(cache.get_map_id('nomap'))
+
+    def test_map_id_of_renamed_map(self):
+        map_ = Map.objects.create(name=u'caf\xe9')
+        self.assertEqual(cache.get_map_id(u'caf\xe9'), map_.id)
+        # game servers send the name utf-8 encoded
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get_map_id(u'caf\xe9'.encode('utf-8')), map_.id)
+        map_ = Map.objects.get(pk=map_.id)
+        map_.name = 'cafe'
+        map_.save()
+        self.assertIsNone(cache.get_map_id(u'caf\xe9'))
+        self.assertEqual(cache.get_map_id('cafe'), map_.id)
+
+    def test_map_data_is_invalidated_by_new_record(self):
+        self.assertIsNone(cache.get_map_data(self.map_.id)['record'])
+        with self.assertNumQueries(0):
+            cache.get_map_data(self.map_.id)
+
+        services.store_race(None, self.player.id, self.map_.id, 30000, [], False)
+        self.assertEqual(cache.get_map_data(self.map_.id)['record']['time'], 30000)
+
+    def test_records_are_written_through(self):
+        other = Player.objects.create(username='cache2', simplified='cache2')
+        services.store_race(None, self.player.id, self.map_.id, 30000, [], False)
+        self.assertEqual(cache.get_map_record(self.map_.id)['time'], 30000)
+        self.assertIsNone(cache.get_player_record(other.id, self.map_.id))
+
+        services.store_race(None, other.id, self.map_.id, 29000, [1000], False)
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get_map_record(self.map_.id)['time'], 29000)
+            self.assertEqual(cache.get_player_record(other.id, self.map_.id)['checkpoints'][0]['time'], 1000)
+            self.assertEqual(cache.get_player_record(self.player.id, self.map_.id)['time'], 30000)
+
+        # with two races only the record gets points
+        services.map_evaluate_points(self.map_.id, reset=False)
+        self.assertGreater(cache.get_player_record(other.id, self.map_.id)['points'], 0)
+        self.assertEqual(cache.get_map_record(self.map_.id)['points'],
+                         cache.get_player_record(other.id, self.map_.id)['points'])
+
+    def test_map_data_is_invalidated_by_oneliner(self):
+        cache.get_map_data(self.map_.id)
+        self.map_.oneliner = 'gg'
+        self.map_.save()
+        self.assertEqual(cache.get_map_data(self.map_.id)['oneliner'], 'gg')
+
+    def test_leaderboard(self):
+        other = Player.objects.create(username='cache2', simplified='cache2')
+        services.store_race(None, self.player.id, self.map_.id, 30000, [1000], False)
+        oneliner, races = cache.get_leaderboard(self.map_.id, 10)
+        self.assertEqual([json.loads(race)['player']['id'] for race in races], [self.player.id])
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get_leaderboard(self.map_.id, 5), (oneliner, races))
+
+        services.store_race(None, other.id, self.map_.id, 29000, [], False)
+        oneliner, races = cache.get_leaderboard(self.map_.id, 10)
+        self.assertEqual([json.loads(race)['time'] for race in races], [29000, 30000])
+        self.assertEqual(cache.get_leaderboard(self.map_.id, 1)[1], races[:1])
+        self.assertEqual(cache.get_leaderboard(self.map_.id, 0)[1], [])
+
+        self.map_.oneliner = 'gg'
+        self.map_.save()
+        self.assertEqual(cache.get_leaderboard(self.map_.id, 10)[0], 'gg')
+
+    def test_map_records_of_a_page(self):
+        maps = [self.map_] + [Map.objects.create(name='cachetest{}'.format(i)) for i in range(5)]
+        for i, map_ in enumerate(maps[:4]):
+            Race.objects.create(player=self.player, map=map_, time=30000 + i)
+            page_player = Player.objects.create(username='page{}'.format(i), simplified='page{}'.format(i))
+            race = Race.objects.create(player=page_player, map=map_, time=20000 + i)
+            Checkpoint.objects.create(race=race, number=0, time=1000 + i)
+
+        # best times, record races and their checkpoints
+        with self.assertNumQueries(3):
+            records = cache.get_map_records([map_.id for map_ in maps])
+        self.assertEqual([records[map_.id] and records[map_.id]['time'] for map_ in maps],
+                         [20000, 20001, 20002, 20003, None, None])
+        self.assertEqual(records[maps[1].id]['checkpoints'][0]['time'], 1001)
+
+        with self.assertNumQueries(0):
+            cache.get_map_records([map_.id for map_ in maps])
+
+    def test_map_index(self):
+        maps = [Map.objects.create(name=name) for name in ('c', 'a', 'b')]
+        Map.objects.create(name='disabled', enabled=False)
+        rl, pg = Tag.objects.create(name='rl'), Tag.objects.create(name='pg')
+        maps[0].tags.add(rl, pg)
+        maps[1].tags.add(rl)
+
+        index = mapindex.get_index()
+        self.assertEqual(index.search([]), [maps[1].id, maps[2].id, maps[0].id, self.map_.id])
+        self.assertEqual(index.search(['RL']), [maps[1].id, maps[0].id])
+        self.assertEqual(index.search(['rl', 'pg']), [maps[0].id])
+        self.assertEqual(index.search(['rl', 'nope']), [])
+
+        with self.assertNumQueries(0):
+            self.assertIs(mapindex.get_index(), index)
+        maps[2].tags.add(pg)
+        self.assertEqual(mapindex.get_index().search(['pg']), [maps[2].id, maps[0].id])
+
+    def test_map_index_pattern(self):
+        maps = [Map.objects.create(name=name) for name in ('a', 'b', 'cachetest2')]
+        index = mapindex.get_index()
+        self.assertEqual(index.search([], '^ca'), [self.map_.id, maps[2].id])
+        self.assertEqual(index.search([], '^CACHETEST$'), [self.map_.id])
+        self.assertEqual(index.search([], 'test2'), [maps[2].id])
+        self.assertEqual(index.search([], 'c.*t2'), [maps[2].id])
+        self.assertEqual(index.search([], '^[ab]$'), [maps[0].id, maps[1].id])
+        self.assertEqual(index.search([], 'nope'), [])
+        self.assertRaises(re.error, index.search, [], '(')
+
+        tag = Tag.objects.create(name='rl')
+        maps[2].tags.add(tag)
+        self.assertEqual(mapindex.get_index().search(['rl'], '^cache'), [maps[2].id])
+
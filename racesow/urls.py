@@ -54,8 +54,11 @@ urlpatterns = patterns(
     (r'^api/map/$', api.APIMapList.as_view()),
     (r'^api/map/([A-Za-z0-9-_=]+)', api.APIMap.as_view()),
     (r'^api/player/([A-Za-z0-9-_=]+)', api.APIPlayer.as_view()),
+    (r'^api/session$', api.APISession.as_view()),
+    (r'^api/counters$', api.APICounters.as_view()),
     (r'^api/nick/([A-Za-z0-9-_=]+)', api.APINick.as_view()),
     (r'^api/race[/]*$', api.APIRace.as_view()),
+    (r'^api/races/batch$', api.APIRaceBatch.as_view()),
     (r'^api/raceall$', api.APIRaceAll.as_view()),
     (r'.+', NotFound.as_view()),
 )
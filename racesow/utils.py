@@ -2,6 +2,7 @@
 import base64
 import hashlib
 import re
+import struct
 from django.utils.html import escape
 
 colorcode_regex = re.compile(r'(\^[0-9])')
@@ -149,4 +150,15 @@ def average(l):
 
 def floats_differ(flt1, flt2):
     """Returns True for floats differing 0.000001 or less, otherwise False"""
-    return abs(float(flt1) - float(flt2)) > 0.000001
\ No newline at end of file
+    return abs(float(flt1) - float(flt2)) > 0.000001
+
+
+def pack_checkpoints(times):
+    """Packs a list of checkpoint times into a little-endian int32 array, as stored in Race.checkpoints"""
+    return struct.pack('<{}i'.format(len(times)), *times)
+
+
+def unpack_checkpoints(data):
+    """Returns the list of checkpoint times packed by pack_checkpoints"""
+    data = bytes(data)
+    return list(struct.unpack('<{}i'.format(len(data) // 4), data))
@@ -1,24 +1,43 @@
 import base64
 import json
-from random import randrange
+import logging
+import re
+from random import choice
 
 from django.core.exceptions import PermissionDenied
-from django.db import DataError, IntegrityError
-from django.db.models import Q
+from django.db import IntegrityError, transaction
 from django.http import HttpResponse, Http404
 from django.utils import timezone
 from django.views.generic import View
 
-from racesow.models import Map, Tag, Player, Race, RaceHistory, Checkpoint
+from racesow import cache, counters, mapindex
+from racesow.models import Map, Tag, Player, Race, RaceHistory, RaceSubmission
 from racesow.serializers import mapSerializer, playerSerializer, raceSerializer
-from racesow.services import get_record, is_default_username
+from racesow.services import (is_default_username, map_assign_ranks, mark_map_dirty, store_race, store_races,
+                              store_session)
+from racesow.tasks import apply_race_submission, recompute_race
 from racesow.utils import strip_color_tokens
-from racesowold.models import Map as Mapold, PlayerMap
-from racesowold.serializers import raceSerializer as raceoldSerializer, playerSerializer as playeroldSerializer
+from racesowold import leaderboards
 
 
 __author__ = 'Mark'
 
+MAX_RACE_BATCH_SIZE = 500  # max number of races accepted by a single APIRaceBatch post
+
+logger = logging.getLogger(__name__)
+
+
+def queue_recompute_race(race_id, old_time, mid):
+    """
+    Queues the re-scoring of a race that was just stored. If the broker cannot be reached the map is marked dirty
+    instead, its points are then evaluated by the next recompute_updated_maps that gets through.
+    """
+    try:
+        recompute_race.delay(race_id, old_time)
+    except Exception:
+        logger.exception('could not queue recompute_race for race {}'.format(race_id))
+        mark_map_dirty(mid)
+
 
 class APIMapList(View):
     """Server API interface for 'randmap' and 'maplist' calls."""
@@ -29,12 +48,16 @@ class APIMapList(View):
 
         # load the tags
         try:
-            pattern = base64.b64decode(request.GET['pattern'].encode('ascii'), '-_')
+            pattern = base64.b64decode(request.GET['pattern'].encode('ascii'), '-_').decode('utf-8')
             tags = json.loads(base64.b64decode(request.GET['tags'].encode('ascii'), '-_'))
         except:
             data = json.dumps({'error': 'Missing parameters'})
             return HttpResponse(data, content_type='application/json', status=400)
 
+        if not isinstance(tags, list) or not all(isinstance(tag, basestring) for tag in tags):
+            data = json.dumps({'error': '<tags> should be a list of tag names'})
+            return HttpResponse(data, content_type='application/json', status=400)
+
         # load the pagination markers
         try:
             start = int(request.GET['start'])
@@ -43,48 +66,51 @@ class APIMapList(View):
             start = 0
             limit = 20
 
-        # Filter by enabled maps
-        flt = Q(enabled=True)
-
-        # Filter by the name and/or tags
-        if pattern:
-            flt = flt & Q(name__iregex=pattern)
-        for t in tags:
-            flt = flt & Q(tags__name__iexact=t)
-
-        maps = Map.objects.filter(flt).order_by('name')
+        # Filter by enabled maps, the name and/or tags in memory
+        try:
+            map_ids = mapindex.get_index().search(tags, pattern)
+        except re.error:
+            data = json.dumps({"error": "Invalid regular expression"})
+            return HttpResponse(data, content_type='application/json', status=400)
 
         # Randmap call?
         if 'rand' in request.GET:
-            count = maps.count()
-            if count:
-                maps = [maps[randrange(count)]]
-            else:
-                maps = tuple()
-        else:
-            maps = maps[start:limit]
-
-        try:
-            # Form the response
+            maps = []
+            while map_ids and not maps:
+                mid = choice(map_ids)
+                try:
+                    maps.append(cache.get_map_data(mid))
+                except Map.DoesNotExist:
+                    # deleted by another process since the index was built, have the index rebuilt
+                    map_ids.remove(mid)
+                    cache.invalidate_map_lists()
             data = {
                 "start": start,
                 "count": len(maps),
-                "maps": []
+                "maps": maps
             }
+            return HttpResponse(json.dumps(data), content_type='application/json')
 
-            # Add serialized maps and records
-            for map_ in maps:
-                smap = mapSerializer(map_)
-                smap['record'] = get_record({'map': map_})
-                data['maps'].append(smap)
+        # the index is ordered by name already, only the maps of the page are loaded
+        page = map_ids[start:limit]
+        positions = dict((mid, i) for i, mid in enumerate(page))
+        maps = sorted(Map.objects.filter(id__in=page).prefetch_related('tags'), key=lambda map_: positions[map_.id])
 
-            status = 200
+        # Form the response
+        data = {
+            "start": start,
+            "count": len(maps),
+            "maps": []
+        }
 
-        except DataError:
-            data = {"error": "Invalid regular expression"}
-            status = 400
+        # Add serialized maps and records
+        records = cache.get_map_records([map_.id for map_ in maps])
+        for map_ in maps:
+            smap = mapSerializer(map_)
+            smap['record'] = records[map_.id]
+            data['maps'].append(smap)
 
-        return HttpResponse(json.dumps(data), content_type='application/json', status=status)
+        return HttpResponse(json.dumps(data), content_type='application/json')
 
     def post(self, request):
         """Add tags to maps here!"""
@@ -101,11 +127,15 @@ class APIMap(View):
             raise PermissionDenied
 
         mapname = base64.b64decode(b64name.encode('ascii'), '-_')
-        map_, created = Map.objects.get_or_create(name=mapname)
+        mid = cache.get_map_id(mapname)
+        if mid is None:
+            # first time the map is played
+            map_, created = Map.objects.get_or_create(name=mapname)
+            mid = map_.id
+            cache.set_map_id(mapname, mid)
 
         # Serialize the data
-        data = mapSerializer(map_)
-        data['record'] = get_record({'map': map_})
+        data = cache.get_map_data(mid)
 
         return HttpResponse(json.dumps(data), content_type='application/json')
 
@@ -138,15 +168,14 @@ class APIMap(View):
                 tag, created = Tag.objects.get_or_create(name=tagname)
                 map_.tags.add(tag)
 
-        map_.races += races
-        map_.playtime += playtime
+        counters.increment(Map, map_.id, races=races, playtime=playtime)
         try:
             new_oneliner = str(request.POST['oneliner'])
             if new_oneliner:
-                map_.oneliner = new_oneliner
+                Map.objects.filter(pk=map_.id).update(oneliner=new_oneliner)
+                cache.invalidate_map(map_.id)
         except:
             pass
-        map_.save()
         return HttpResponse('', content_type='text/plain')
 
 
@@ -171,16 +200,16 @@ class APIPlayer(View):
 
                 player.name = username
                 player.simplified = username
-                player.save()
+                player.save(update_fields=['name', 'simplified'])
         except:
             raise Http404
 
         # Serialize the player
         data = playerSerializer(player)
-        data['record'] = get_record({
-            'player': player,
-            'map_id': request.GET['mid']
-        })
+        try:
+            data['record'] = cache.get_player_record(player.id, int(request.GET['mid']))
+        except ValueError:
+            data['record'] = None
 
         return HttpResponse(json.dumps(data), content_type='application/json')
 
@@ -209,38 +238,32 @@ class APIPlayer(View):
             data = json.dumps({'error': 'Could not make race for user/map combination'})
             return HttpResponse(data, content_type='application/json', status=400)
 
-        try:
-            map_ = Map.objects.get(pk=mid)
-        except Map.DoesNotExist:
+        if not Map.objects.filter(pk=mid).exists():
             data = json.dumps({'error': 'Could not find map with id {}'.format(mid)})
             return HttpResponse(data, content_type='application/json', status=400)
 
         try:
             # update player's statistics
-            player.playtime += playtime
-            player.races += races
-            if created:
-                player.maps += 1
-            player.save()
+            counters.increment(Player, player.id, playtime=playtime, races=races, maps=1 if created else 0)
 
             # update information for the race
-            race.playtime += playtime
+            counters.increment(Race, race.id, playtime=playtime)
             race.last_played = timezone.now()
             race.set_points(-1)  # set negative points to indicate that this race is not yet processed
-            race.save()
+            race.save(update_fields=['last_played', 'points'])
 
-            raceh = RaceHistory.objects.create(
+            # the playtime of the race includes the increments that are still buffered
+            RaceHistory.objects.create(
                 player_id=player.id,
                 map_id=mid,
                 server=race.server,
                 time=race.time,
-                playtime=race.playtime,
+                playtime=race.playtime + counters.pending(Race, race.id, 'playtime'),
                 created=race.created,
                 last_played=race.last_played)
 
-            # trigger computation of points for this map in next scheduled task
-            map_.compute_points = True
-            map_.save()
+            # trigger computation of points for this map
+            mark_map_dirty(mid)
         except:
             # TODO remove debug code
             import traceback
@@ -251,6 +274,54 @@ class APIPlayer(View):
         return HttpResponse('', content_type='text/plain')
 
 
+class APISession(View):
+    """Server API interface for reporting the scoreboard of a map session."""
+
+    def post(self, request):
+        """
+        Update the playtime and race counts of all players of a session, replacing an APIPlayer.post per player
+
+        Players are given as a list of {"username": "...", "playTime": 1234, "races": 3}
+        """
+        if not hasattr(request, 'server'):
+            raise PermissionDenied
+
+        try:
+            mid = int(request.POST['mid'])
+            entries = json.loads(request.POST['players'])
+            assert isinstance(entries, list)
+        except:
+            data = json.dumps({'error': 'Missing parameters for session'})
+            return HttpResponse(data, content_type='application/json', status=400)
+
+        if not Map.objects.filter(pk=mid).exists():
+            data = json.dumps({'error': 'Could not find map with id {}'.format(mid)})
+            return HttpResponse(data, content_type='application/json', status=400)
+
+        try:
+            unknown = store_session(mid, entries)
+        except (KeyError, TypeError, ValueError):
+            data = json.dumps({'error': 'Invalid player entry'})
+            return HttpResponse(data, content_type='application/json', status=400)
+        except IntegrityError:
+            # races of the session were created concurrently, nothing was stored
+            data = json.dumps({'error': 'Conflicting races, retry the session'})
+            return HttpResponse(data, content_type='application/json', status=409)
+
+        data = json.dumps({'unknown': unknown})
+        return HttpResponse(data, content_type='application/json')
+
+
+class APICounters(View):
+    """Server API interface for the metrics of the counter buffer of the serving process."""
+
+    def get(self, request):
+        if not hasattr(request, 'server'):
+            raise PermissionDenied
+
+        return HttpResponse(json.dumps(counters.stats()), content_type='application/json')
+
+
 class APINick(View):
     """Check if a nickname is protected."""
 
@@ -284,7 +355,7 @@ class APINick(View):
             else:
                 player.name = request.POST['nick']
                 player.simplified = strip_color_tokens( request.POST['nick'] )
-                player.save()
+                player.save(update_fields=['name', 'simplified'])
                 data = {player.name: True}
                 status = 200
 
@@ -318,27 +389,16 @@ class APIRace(View):
             data = json.dumps({'error': 'Invalid or missing parameter <limit>'})
             return HttpResponse(data, content_type='application/json', status=400)
 
-        try:
-            map_ = Map.objects.get(name=mapname)
-        except:
+        mid = cache.get_map_id(mapname)
+        if mid is None:
             data = json.dumps({'error': 'Could not find map \'{}\''.format(mapname)})
             return HttpResponse(data, content_type='application/json', status=400)
+        oneliner, races = cache.get_leaderboard(mid, limit)
 
-        races = Race.objects.filter(map=map_, time__isnull=False).order_by('time')[:limit]
-        data = {
-            "map": mapname,
-            "oneliner": map_.oneliner,
-            "count": len(races),
-            "races": []
-        }
-
-        for race in races:
-            srace = raceSerializer(race)
-            srace['player'] = playerSerializer(race.player)
-            del srace['playerId']
-            data['races'].append(srace)
-
-        return HttpResponse(json.dumps(data), content_type='application/json')
+        # the races are cached as JSON already
+        data = '{{"map": {}, "oneliner": {}, "count": {}, "races": [{}]}}'.format(
+            json.dumps(mapname), json.dumps(oneliner), len(races), ', '.join(races))
+        return HttpResponse(data, content_type='application/json')
 
     def post(self, request):
         if not hasattr(request, 'server'):
@@ -349,64 +409,102 @@ class APIRace(View):
             mid = int(request.POST['mid'])
             time = int(request.POST['time'])
             clear_oneliner = int(request.POST['co']) == 1
-            checkpoints = json.loads(request.POST['checkpoints'])
+            checkpoints = [int(t) for t in json.loads(request.POST['checkpoints'])]
         except Exception as e:
             print e
             data = json.dumps({'error': 'Missing parameters for user'})
             return HttpResponse(data, content_type='application/json', status=400)
 
-        try:
-            player = Player.objects.get(id=pid)
-            map_ = Map.objects.get(id=mid)
-        except:
+        if not Player.objects.filter(pk=pid).exists() or not Map.objects.filter(pk=mid).exists():
             raise Http404
 
-        if clear_oneliner:
-            # remove old oneliner
-            map_.oneliner = ""
-            # trigger computation of points for this map in next scheduled task
-            map_.compute_points = True
-            map_.save()
-
-        # No checks that the race is faster. That should be done on the gameserver
-        race, created = Race.objects.get_or_create(player_id=pid, map_id=mid)
-
-        if created:
-            player.maps += 1
-            player.save()
-
-        # Update race history
-        raceh = RaceHistory.objects.create(
-            player_id=pid,
-            map_id=mid,
-            server=request.server,
-            time=time,
-            playtime=race.playtime,
-            created=race.created,
-            last_played=race.last_played)
-
-        # Update the record race
-        race.set_points(-1)  # set negative points to indicate that this race is not yet processed
-        race.server = request.server
-        race.time = time
-        race.created = timezone.now()
-        race.last_played = timezone.now()
-        race.save()
-
-        # Delete old checkpoints
-        # Since the server will always send all checkpoints, we might can use
-        # update_or_create instead of delete/bulk_create
-        if not created:
-            Checkpoint.objects.filter(race=race).delete()
-
-        # Make new checkpoints
-        Checkpoint.objects.bulk_create([
-            Checkpoint(race_id=race.id, number=i, time=t) for i, t in enumerate(checkpoints)
-        ])
+        key = request.POST.get('key')
+        if key:
+            return self.submit(request, key, {'pid': pid, 'mid': mid, 'time': time, 'checkpoints': checkpoints,
+                                              'co': int(clear_oneliner)})
+
+        race, old_time = store_race(request.server, pid, mid, time, checkpoints, clear_oneliner)
+
+        # update the medals right away, the points follow asynchronously
+        map_assign_ranks(mid)
+
+        # re-score the affected part of the map ranking
+        queue_recompute_race(race.id, old_time, mid)
 
         data = raceSerializer(race)
         return HttpResponse(json.dumps(data), content_type='application/json')
 
+    def submit(self, request, key, race):
+        """
+        Store the race asynchronously, the response only confirms that it was received
+
+        The key identifies the race for the server. Posting a race with a key that was used before does not store it
+        again, so servers can safely retry posts that timed out.
+        """
+        if len(key) > RaceSubmission._meta.get_field('key').max_length:
+            data = json.dumps({'error': 'Invalid parameter <key>'})
+            return HttpResponse(data, content_type='application/json', status=400)
+
+        try:
+            with transaction.atomic():
+                submission = RaceSubmission.objects.create(server=request.server, key=key, payload=json.dumps(race))
+        except IntegrityError:
+            # retry of an earlier post
+            submission = RaceSubmission.objects.get(server=request.server, key=key)
+
+        if submission.applied is None:
+            # applying the same submission twice is a no-op, so a retry may queue it again
+            try:
+                apply_race_submission.delay(submission.id)
+            except Exception:
+                # the submission is stored, retry_race_submissions queues it once the broker is back
+                logger.exception('could not queue apply_race_submission for submission {}'.format(submission.id))
+
+        data = json.dumps({'key': key, 'applied': submission.applied is not None})
+        return HttpResponse(data, content_type='application/json', status=202)
+
+
+class APIRaceBatch(View):
+    """Server API interface for submitting many races in one request."""
+
+    def post(self, request):
+        """
+        Store a list of races, each given as {"pid": 1, "mid": 2, "time": 30295, "checkpoints": [...], "co": 0}
+
+        Responds with a list holding the stored race or an error for every entry, in the order they were sent.
+        """
+        if not hasattr(request, 'server'):
+            raise PermissionDenied
+
+        try:
+            entries = json.loads(request.POST['races'])
+            assert isinstance(entries, list)
+        except:
+            data = json.dumps({'error': 'Invalid or missing parameter <races>'})
+            return HttpResponse(data, content_type='application/json', status=400)
+
+        if len(entries) > MAX_RACE_BATCH_SIZE:
+            data = json.dumps({'error': 'At most {} races can be sent at once'.format(MAX_RACE_BATCH_SIZE)})
+            return HttpResponse(data, content_type='application/json', status=400)
+
+        try:
+            results, old_times = store_races(request.server, entries)
+        except IntegrityError:
+            # races of the batch were created concurrently, nothing was stored
+            data = json.dumps({'error': 'Conflicting races, retry the batch'})
+            return HttpResponse(data, content_type='application/json', status=409)
+
+        # update the medals right away, the points follow asynchronously
+        race_maps = dict((result['id'], result['mapId']) for result in results if 'error' not in result)
+        for mid in set(race_maps.values()):
+            map_assign_ranks(mid)
+
+        # re-score the affected parts of the map rankings
+        for race_id, old_time in old_times:
+            queue_recompute_race(race_id, old_time, race_maps[race_id])
+
+        return HttpResponse(json.dumps(results), content_type='application/json')
+
 
 class APIRaceAll(View):
     """Server API interface for Race objects (new and old)."""
@@ -431,47 +529,29 @@ class APIRaceAll(View):
             return HttpResponse(data, content_type='application/json', status=400)
 
         # 1.5
-        try:
-            map_ = Map.objects.get(name=mapname)
-            races = Race.objects.filter(map=map_, time__isnull=False).order_by('time')[:limit]
-        except:
-            map_ = None
-            races = []
-
-        # 1.0
-        try:
-            mapold_ = Mapold.objects.get(name=mapname)
-            oldraces = PlayerMap.objects.filter(map=mapold_, time__isnull=False, player__isnull=False, prejumped='false').order_by('time')[:limit]
-        except:
-            if not map_:
-                data = json.dumps({'error': 'Could not find map \'{}\''.format(mapname)})
-                return HttpResponse(data, content_type='application/json', status=400)
-            mapold_ = None
-            oldraces = []
+        mid = cache.get_map_id(mapname)
+        if mid is not None:
+            oneliner, races = cache.get_leaderboard(mid, limit)
+        else:
+            oneliner, races = '', []
 
-        # 1.0
+        # 1.0, precomputed
+        old = leaderboards.get_leaderboard(mapname, limit)
+        if mid is None and old is None:
+            data = json.dumps({'error': 'Could not find map \'{}\''.format(mapname)})
+            return HttpResponse(data, content_type='application/json', status=400)
+        oldname, oldoneliner, oldraces = old if old is not None else (None, '', [])
 
         data = {
-            "map": map_.name if map_ else mapold_.name,
-            "oneliner": map_.oneliner if map_ else '',
+            "map": mapname if mid is not None else oldname,
+            "oneliner": oneliner,
             "count": min(len(races) + len(oldraces), limit),
-            "races": [],
-            "oldoneliner": mapold_.oneliner if mapold_ else '',
-            "oldraces": []
         }
 
-        for race in races:
-            srace = raceSerializer(race)
-            srace['player'] = playerSerializer(race.player)
-            del srace['playerId']
-            data['races'].append(srace)
-
-        for race in oldraces:
-            srace = raceoldSerializer(race)
-            srace['player'] = playeroldSerializer(race.player)
-            data['oldraces'].append(srace)
-
-        return HttpResponse(json.dumps(data), content_type='application/json')
+        # the races of both versions are cached as JSON already
+        data = '{}, "races": [{}], "oldoneliner": {}, "oldraces": [{}]}}'.format(
+            json.dumps(data)[:-1], ', '.join(races), json.dumps(oldoneliner), ', '.join(oldraces))
+        return HttpResponse(data, content_type='application/json')
 
     def post(self, request):
         raise Http404
@@ -13,6 +13,7 @@ from racesowold.models import Map as Mapold, PlayerMap, Player as Playerold
 
 PAGE_LIMIT = 20  # number of results per page
 BUTTONS_PER_PAGE = 5  # the max number of pagebuttons we want to allow
+RANK_CHART_SIZE = (450, 80)  # width and height in pixels of the rank history chart
 
 
 ##################
@@ -49,6 +50,20 @@ def get_pagebuttons_for_page(objects, page):
     return range(max(1, page - 2), min(paginator.num_pages + 1, page + 3))
 
 
+def get_rank_chart(snapshots):
+    """
+    Returns the svg polyline points of a player's rank history, one point per snapshot with rank 1 at the top.
+    """
+    width, height = RANK_CHART_SIZE
+    best = min(snapshot.rank for snapshot in snapshots)
+    worst = max(snapshot.rank for snapshot in snapshots)
+    step = float(width) / max(len(snapshots) - 1, 1)
+    scale = float(height - 10) / max(worst - best, 1)
+    points = ' '.join('{:.1f},{:.1f}'.format(i * step, 5 + (snapshot.rank - best) * scale)
+                      for i, snapshot in enumerate(snapshots))
+    return {'points': points, 'width': width, 'height': height, 'best': best, 'worst': worst}
+
+
 #####################
 # Class-based views #
 #####################
@@ -217,8 +232,7 @@ class MapDetails(View):
             context['last_run'] = map_.last_computation
 
             # celery next computation date
-            if map_.compute_points:
-                context['next_run'] = services.get_next_computation_date()
+            context['next_run'] = services.get_next_computation_date(map_)
 
             # create URL to .pk3 file
             if map_.pk3file:
@@ -426,6 +440,15 @@ class PlayerDetails(View):
             player.skill = player.get_points() / player.maps_finished if player.maps_finished else 0
             player.pmaps = len(pmaps_list)
 
+            # leaderboard history from the daily snapshots
+            rank_history = services.get_rank_history(player, days=30)
+            if rank_history:
+                context.update({'leaderboard': {
+                    'rank': rank_history[-1].rank,
+                    'chart': get_rank_chart(rank_history) if len(rank_history) > 1 else None,
+                    'points_week': services.get_points_gained(player, days=7)}
+                })
+
             context.update({'medals': {
                 'gold': len(Race.objects.filter(player=player, rank=1)),
                 'silver': len(Race.objects.filter(player=player, rank=2)),
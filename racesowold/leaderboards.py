@@ -0,0 +1,96 @@
+"""
+Precomputed leaderboards of the frozen Racesow 1.0 maps, as sent by APIRaceAll
+
+The 1.0 data never changes, so the leaderboard of every map is written once to a JSON file in
+settings.LEGACY_LEADERBOARD_DIR by the build_legacy_leaderboards command. Files are loaded on first use and kept in
+memory by every process. Until the command has completed, the leaderboards are read from the database.
+"""
+import hashlib
+import json
+import os
+
+from django.conf import settings
+
+from racesowold.models import Map, PlayerMap
+from racesowold.serializers import playerSerializer, raceSerializer
+
+MAX_CACHED_LEADERBOARDS = 1000  # leaderboards kept in memory per process
+COMPLETE_FILE = 'complete'  # written once the leaderboards of all maps are in the directory
+
+_leaderboards = {}
+
+
+def _key(name):
+    # names from the database are unicode, names sent by game servers utf-8 encoded
+    if not isinstance(name, unicode):
+        name = name.decode('utf-8', 'replace')
+    return name.lower()
+
+
+def _path(name):
+    # map names can contain characters that are not allowed in file names
+    return os.path.join(settings.LEGACY_LEADERBOARD_DIR,
+                        hashlib.md5(_key(name).encode('utf-8')).hexdigest() + '.json')
+
+
+def build_leaderboard(map_, size=None):
+    """Returns the serialized leaderboard of 1.0 map 'map_', with at most 'size' races if given"""
+    races = PlayerMap.objects.filter(map=map_, time__isnull=False, player__isnull=False, prejumped='false')\
+        .order_by('time').select_related('player')
+    if size is not None:
+        races = races[:size]
+
+    data = {'name': map_.name, 'oneliner': map_.oneliner or '', 'races': []}
+    for race in races:
+        srace = raceSerializer(race)
+        srace['player'] = playerSerializer(race.player)
+        data['races'].append(srace)
+    return data
+
+
+def write_leaderboard(map_, size=None):
+    """Writes the leaderboard of 1.0 map 'map_' to its file, maps with the same (case-insensitive) name share it"""
+    path = _path(map_.name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(build_leaderboard(map_, size), f)
+    # readers never see a partially written file
+    os.rename(path + '.tmp', path)
+
+
+def mark_complete():
+    """Marks the leaderboard files as complete, from then on they are used instead of the database"""
+    open(os.path.join(settings.LEGACY_LEADERBOARD_DIR, COMPLETE_FILE), 'w').close()
+
+
+def _load(name):
+    if not os.path.exists(os.path.join(settings.LEGACY_LEADERBOARD_DIR, COMPLETE_FILE)):
+        # case-insensitive like the files, the oldest map of a name is used
+        maps = list(Map.objects.filter(name__iexact=name).order_by('id')[:1])
+        return build_leaderboard(maps[0]) if maps else None
+
+    try:
+        with open(_path(name)) as f:
+            return json.load(f)
+    except IOError:
+        # not a 1.0 map
+        return None
+
+
+def get_leaderboard(name, limit):
+    """Returns the name and oneliner of 1.0 map 'name' and its 'limit' fastest races
+
+    :return: (name, oneliner, list of JSON encoded races with their player), None if there is no such map
+    """
+    key = _key(name)
+    if key not in _leaderboards:
+        data = _load(name)
+        if data is not None:
+            data = (data['name'], data['oneliner'], [json.dumps(race) for race in data['races']])
+        if len(_leaderboards) >= MAX_CACHED_LEADERBOARDS:
+            _leaderboards.clear()
+        _leaderboards[key] = data
+
+    data = _leaderboards[key]
+    if data is None:
+        return None
+    return data[0], data[1], data[2][:max(limit, 0)]
@@ -0,0 +1,41 @@
+"""
+Writes the leaderboards of all Racesow 1.0 maps to settings.LEGACY_LEADERBOARD_DIR
+
+APIRaceAll serves the 1.0 half of its responses from these files instead of querying the racesowold tables, see
+racesowold/leaderboards.py. The 1.0 data is frozen, so this only needs to be run once per deployment. Processes that
+are already running keep the leaderboards they loaded, restart them after (re)building.
+
+Usage:
+    python manage.py build_legacy_leaderboards [--size 1000]
+"""
+import os
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from racesowold.leaderboards import mark_complete, write_leaderboard
+from racesowold.models import Map
+
+
+class Command(BaseCommand):
+    help = 'Precomputes the leaderboards of the Racesow 1.0 maps'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--size', type='int', default=None,
+                    help='Maximum number of races stored per map, all races by default'),
+    )
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(settings.LEGACY_LEADERBOARD_DIR):
+            os.makedirs(settings.LEGACY_LEADERBOARD_DIR)
+
+        names = set()
+        for map_ in Map.objects.order_by('id').iterator():
+            # maps with names differing in case only share a file, the oldest one is kept
+            if map_.name.lower() not in names:
+                write_leaderboard(map_, options['size'])
+                names.add(map_.name.lower())
+        mark_complete()
+
+        self.stdout.write('Wrote the leaderboards of {} maps to {}'.format(len(names), settings.LEGACY_LEADERBOARD_DIR))
@@ -82,8 +82,10 @@ def raceSerializer(race):
     created = race.created
     if not created:
         created = '0000-00-00'
-    elif timezone.is_aware( created ):
-        created = timezone.localtime(created, timezone=timezone.utc)
+    else:
+        if timezone.is_aware( created ):
+            created = timezone.localtime(created, timezone=timezone.utc)
+        created = created.strftime("%Y-%m-%d - %H:%M:%S")
 
     return {
         'id': race.id,
@@ -93,5 +95,5 @@ def raceSerializer(race):
         'time': race.time,
         'points': race.points,
         'playtime': race.playtime,
-        'created': created.strftime("%Y-%m-%d - %H:%M:%S")
+        'created': created
     }
@@ -1,3 +1,45 @@
+"""
+Tests of the Racesow 1.0 data
+
+Usage (debian) from the /website directory:
+    python manage.py test racesowold
+"""
+import json
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import override_settings
+
+from .models import Map, Player, PlayerMap
+from racesowold import leaderboards
+
+
+class LegacyLeaderboardTests(TestCase):
+
+    def setUp(self):
+        leaderboards._leaderboards.clear()
+        self.directory = tempfile.mkdtemp()
+        self.map_ = Map.objects.create(name='Legacytest', oneliner='old')
+        player = Player.objects.create(name='old', simplified='old')
+        for time, prejumped in ((20000, 'false'), (10000, 'true'), (30000, 'false')):
+            PlayerMap.objects.create(player=player, map=self.map_, time=time, prejumped=prejumped)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        leaderboards._leaderboards.clear()
+
+    def test_build(self):
+        with override_settings(LEGACY_LEADERBOARD_DIR=self.directory):
+            # read from the database until the files are complete
+            name, oneliner, races = leaderboards.get_leaderboard('legacytest', 10)
+            self.assertEqual([json.loads(race)['time'] for race in races], [20000, 30000])
 
-# Create your tests here.
+            call_command('build_legacy_leaderboards', stdout=StringIO())
+            leaderboards._leaderboards.clear()
+            with self.assertNumQueries(0):
+                self.assertEqual(leaderboards.get_leaderboard('LEGACYTEST', 1), (name, oneliner, races[:1]))
+                self.assertIsNone(leaderboards.get_leaderboard('nomap', 10))
+        self.assertEqual((name, oneliner), ('Legacytest', 'old'))